@@ -0,0 +1,297 @@
+# encoding: utf-8
+"""
+Benchmark each phase of a ReligionMap style run on synthetic data.
+
+Random land polygons and input points are generated (from a seed, so runs are
+repeatable) in a throwaway set of tables in the given database (or in files,
+for the memory backend). Then every phase is run and timed, and the time,
+cells/sec and peak memory of each phase is saved as JSON, along with the git
+commit, so runs can be compared across commits.
+
+Memory is sampled from /proc while each phase runs (this process and it's
+child processes, e.g. with --processes), so it's only measured on Linux.
+memory_growth_kb is the phase's peak minus the memory when it started.
+
+e.g. python benchmark.py -d bench --size 2 --increment 0.02 --points-per-sq-degree 2000 -o before.json
+"""
+from __future__ import division
+
+import argparse
+import csv
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from common import batch, copy_rows, ewkb_point
+from religion_map import ReligionMap
+
+RELIGIONS = [
+    ('christian', ['catholic', 'anglican', 'methodist', 'orthodox', '']),
+    ('muslim', ['sunni', 'shia', '']),
+    ('jewish', ['orthodox', 'reform', '']),
+    ('hindu', ['']),
+    ('buddhist', ['']),
+]
+
+
+class BenchmarkReligionMap(ReligionMap):
+    input_data_table = "bench_religion_point"
+    land = "bench_land.the_geom"
+    output_table = "bench_output"
+
+
+def synthetic_land(rand, minlon, minlat, size, num_polygons):
+    """List of land polygons, each a list of (lon, lat), roughly round blobs"""
+    polygons = []
+    for _ in range(num_polygons):
+        centre_lon, centre_lat = minlon + rand.random() * size, minlat + rand.random() * size
+        radius = size * (0.1 + rand.random() * 0.3)
+        ring = []
+        for i in range(32):
+            angle = 2 * math.pi * i / 32
+            r = radius * (0.7 + rand.random() * 0.3)
+            ring.append((centre_lon + r * math.cos(angle), centre_lat + r * math.sin(angle)))
+        ring.append(ring[0])
+        polygons.append(ring)
+    return polygons
+
+def synthetic_points(rand, minlon, minlat, size, num_points):
+    """Yield (lon, lat, religion, denomination)"""
+    for _ in range(num_points):
+        religion, denominations = rand.choice(RELIGIONS)
+        yield (minlon + rand.random() * size, minlat + rand.random() * size, religion, rand.choice(denominations))
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def child_pids(pid):
+    """The pids of the processes whose parent is pid"""
+    children = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/{0}/stat".format(name)) as fp:
+                stat = fp.read()
+        except IOError:
+            continue
+        # after the command name (in brackets) is the state, then the parent pid
+        if int(stat.rsplit(")", 1)[1].split()[1]) == pid:
+            children.append(int(name))
+    return children
+
+def current_memory_kb():
+    """Resident memory right now of this process and it's child processes, or None if there's no /proc"""
+    if not os.path.exists("/proc/self/statm"):
+        return None
+    page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+    pid = os.getpid()
+    total = 0
+    for process in [pid] + child_pids(pid):
+        try:
+            with open("/proc/{0}/statm".format(process)) as fp:
+                total += int(fp.read().split()[1]) * page_kb
+        except IOError:
+            # it's just finished
+            pass
+    return total
+
+
+class MemorySampler(object):
+    """
+    Record the peak of current_memory_kb in a with block, by checking it
+    every interval seconds in a thread. (ru_maxrss can't be used, since it's
+    the peak for the whole life of the process, not one phase.)
+    """
+    interval = 0.1
+
+    def __init__(self):
+        self.start_kb = self.peak_kb = current_memory_kb()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.update()
+
+    def update(self):
+        memory = current_memory_kb()
+        if memory is not None:
+            self.peak_kb = max(self.peak_kb, memory)
+
+    def __enter__(self):
+        if self.start_kb is not None:
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start_kb is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.update()
+
+    def growth_kb(self):
+        return None if self.start_kb is None else self.peak_kb - self.start_kb
+
+
+class Benchmark(object):
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-d', '--database', type=str, help="Database to make the bench_* tables in (they're dropped afterwards)")
+        parser.add_argument('--backend', default='postgis', choices=['postgis', 'memory'])
+        parser.add_argument('--size', default=2.0, type=float, help="Width & height of the area, in degrees")
+        parser.add_argument('--increment', default=0.02, type=float)
+        parser.add_argument('--points-per-sq-degree', default=1000, type=int)
+        parser.add_argument('--land-polygons', default=10, type=int)
+        parser.add_argument('--seed', default=1, type=int)
+        parser.add_argument('--aggregator-args', default="", type=str, help="Extra options for the aggregator, e.g. '--copy --workers 4'")
+        parser.add_argument('-o', '--output', default=None, type=str, help="JSON file to save the results to")
+        parser.add_argument('--keep', action='store_true', help="Don't drop the tables afterwards")
+        self.args = parser.parse_args()
+        if self.args.backend == 'postgis':
+            assert self.args.database
+
+        self.minlon, self.minlat = -self.args.size / 2, 50.0
+
+    def aggregator_args(self):
+        args = [
+            '--left', repr(self.minlon), '--right', repr(self.minlon + self.args.size),
+            '--bottom', repr(self.minlat), '--top', repr(self.minlat + self.args.size),
+            '--increment', repr(self.args.increment),
+        ]
+        if self.args.database:
+            args += ['--database', self.args.database]
+        return args + self.args.aggregator_args.split()
+
+    def create_tables(self, aggregator, land, points):
+        conn = aggregator.database_connection()
+        cursor = conn.cursor()
+        self.drop_tables(aggregator)
+
+        cursor.execute("CREATE TABLE bench_land (id serial primary key, the_geom geometry(Polygon, 4326));")
+        for ring in land:
+            wkt = "POLYGON((" + ", ".join("{0!r} {1!r}".format(x, y) for x, y in ring) + "))"
+            cursor.execute("INSERT INTO bench_land (the_geom) VALUES (ST_GeomFromText(%s, 4326));", [wkt])
+
+        cursor.execute("CREATE TABLE bench_religion_point (the_geom geometry(Point, 4326), religion text, denomination text);")
+        copy_rows(cursor, "bench_religion_point", ["the_geom", "religion", "denomination"],
+                  ((ewkb_point(lon, lat, 4326), religion, denomination) for (lon, lat, religion, denomination) in points))
+
+        cursor.execute("CREATE INDEX bench_land__the_geom ON bench_land USING gist (the_geom);")
+        cursor.execute("CREATE INDEX bench_religion_point__the_geom ON bench_religion_point USING gist (the_geom);")
+        cursor.execute("ANALYZE bench_land;")
+        cursor.execute("ANALYZE bench_religion_point;")
+        conn.commit()
+
+    def drop_tables(self, aggregator):
+        conn = aggregator.database_connection()
+        cursor = conn.cursor()
+        # and the subdivided land, if --subdivide-land was used
+        for table in set(["bench_land", aggregator.land_table, "bench_religion_point", aggregator.output_table]):
+            cursor.execute("DROP TABLE IF EXISTS {0};".format(table))
+        conn.commit()
+
+    def write_files(self, directory, land, points):
+        land_file = os.path.join(directory, "land.geojson")
+        with open(land_file, 'w') as fp:
+            json.dump({'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Polygon', 'coordinates': [ring]}} for ring in land
+            ]}, fp)
+
+        input_file = os.path.join(directory, "points.csv")
+        with open(input_file, 'w') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(['lon', 'lat', 'religion', 'denomination'])
+            for rows in batch(points, 10000):
+                writer.writerows(rows)
+
+        return land_file, input_file
+
+    def count_cells(self, aggregator):
+        cursor = aggregator.database_connection().cursor()
+        cursor.execute("SELECT count(*) FROM {0};".format(aggregator.output_table))
+        return cursor.fetchall()[0][0]
+
+    def time_phase(self, name, func, count_cells):
+        print "\n== {0} ==".format(name)
+        started = time.time()
+        with MemorySampler() as memory:
+            func()
+        seconds = time.time() - started
+        cells = count_cells()
+        result = {
+            'phase': name,
+            'seconds': seconds,
+            'cells': cells,
+            'cells_per_second': (cells / seconds) if seconds > 0 else None,
+            'peak_memory_kb': memory.peak_kb,
+            'memory_growth_kb': memory.growth_kb(),
+        }
+        self.results['phases'].append(result)
+        return result
+
+    def run(self):
+        self.parse_args()
+        rand = random.Random(self.args.seed)
+        num_points = int(self.args.points_per_sq_degree * self.args.size * self.args.size)
+        land = synthetic_land(rand, self.minlon, self.minlat, self.args.size, self.args.land_polygons)
+        points = synthetic_points(rand, self.minlon, self.minlat, self.args.size, num_points)
+
+        self.results = {
+            'commit': git_commit(),
+            'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'settings': vars(self.args),
+            'input_points': num_points,
+            'phases': [],
+        }
+
+        aggregator = BenchmarkReligionMap()
+
+        if self.args.backend == 'memory':
+            from memory import MemoryBackend
+            directory = tempfile.mkdtemp()
+            try:
+                land_file, input_file = self.write_files(directory, land, points)
+                output_file = os.path.join(directory, "output.geojsonl")
+                aggregator.parse_args(self.aggregator_args() + ['--backend', 'memory', '--land-file', land_file, '--input-file', input_file, '--output-file', output_file])
+                self.time_phase('memory', MemoryBackend(aggregator).run, lambda: sum(1 for line in open(output_file)))
+            finally:
+                shutil.rmtree(directory)
+        else:
+            aggregator.parse_args(self.aggregator_args() + ['--start-from-scratch'])
+            self.create_tables(aggregator, land, points)
+            count_cells = lambda: self.count_cells(aggregator)
+            try:
+                self.time_phase('create_table', aggregator.create_table, count_cells)
+                self.time_phase('prepare_land', aggregator.prepare_land, count_cells)
+                self.time_phase('create_land_boxes', aggregator.create_land_boxes, count_cells)
+                self.time_phase('populate_raw_data', aggregator.populate_raw_data, count_cells)
+                self.time_phase('calculate_properties', aggregator.calculate_properties, count_cells)
+                self.time_phase('convert_to_polygons', aggregator.convert_to_polygons, count_cells)
+            finally:
+                if not self.args.keep:
+                    self.drop_tables(aggregator)
+
+        print
+        for phase in self.results['phases']:
+            print "{phase:>22}: {seconds:8.2f}s {cells:>9} cells, peak memory {peak_memory_kb} KB (+{memory_growth_kb} KB)".format(**phase)
+
+        output = self.args.output or "benchmark-{0}.json".format((self.results['commit'] or "unknown")[:10])
+        with open(output, 'w') as fp:
+            json.dump(self.results, fp, indent=2)
+        print "Saved results to {0}".format(output)
+
+
+if __name__ == '__main__':
+    Benchmark().run()
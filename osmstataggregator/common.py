@@ -2,9 +2,27 @@
 from __future__ import division
 
 import argparse
+import binascii
+import csv
+import datetime
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
 import psycopg2
-from collections import Counter
+import psycopg2.extensions
+from collections import Counter, deque
+import Queue
+import struct
 import sys
+import threading
+import time
+
+from instrumentation import Instrumentation, InstrumentedConnection
+
+# On the sphere ST_Distance_Sphere uses
+METRES_PER_DEGREE = 6370986.0 * math.pi / 180
 
 def percentage_printer(input, msg=None, total=None):
     if total is None:
@@ -47,6 +65,92 @@ def frange(start, stop, step=None):
         cur += step
 
 
+def progress_message(done, total, started):
+    """A message about how far through we are, with an estimate of time remaining"""
+    elapsed = time.time() - started
+    if done > 0:
+        eta = datetime.timedelta(seconds=int(elapsed * (total - done) / done))
+    else:
+        eta = "unknown"
+    return "[{percent:3d}%] {done}/{total}, ETA {eta}".format(percent=int((done * 100) / total), done=done, total=total, eta=eta)
+
+def bounded_imap(pool, func, iterable, max_in_flight):
+    """
+    Like pool.imap, but only ever has max_in_flight items waiting to be
+    processed, so the iterable isn't read into memory faster than the pool can
+    process it.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        while len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+# The aggregator object used in each properties worker process
+_worker_aggregator = None
+
+def _init_properties_worker(aggregator):
+    global _worker_aggregator
+    _worker_aggregator = aggregator
+
+def _compute_properties_in_worker(records):
+    return _worker_aggregator.compute_properties(records)
+
+
+class IteratorFile(object):
+    """
+    A read-only file-like object which reads from an iterator of strings. This
+    lets psycopg2's copy_expert stream from a generator, without having all
+    the data in memory.
+    """
+    def __init__(self, iterator):
+        self.iterator = iterator
+        self.buffer = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.iterator)
+            except StopIteration:
+                break
+        if size < 0:
+            result, self.buffer = self.buffer, ""
+        else:
+            result, self.buffer = self.buffer[:size], self.buffer[size:]
+        return result
+
+    readline = read
+
+def copy_value(value):
+    """Convert a python value to postgres' COPY text format"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, unicode):
+        value = value.encode("utf8")
+    value = repr(value) if isinstance(value, float) else str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def copy_rows(cursor, table, columns, rows):
+    """COPY the rows (an iterable of tuples) into table, streaming them"""
+    lines = ("\t".join(copy_value(v) for v in row) + "\n" for row in rows)
+    query = "COPY {0} ( {1} ) FROM STDIN;".format(table, ", ".join(columns))
+    cursor.copy_expert(query, IteratorFile(lines))
+
+def ewkb_point(x, y, srid):
+    """Hex encoded EWKB of a point, which postgres will accept as a geometry"""
+    return binascii.hexlify(struct.pack("<BIIdd", 1, 0x20000001, srid, x, y))
+
+def ewkb_box(minx, miny, maxx, maxy, srid):
+    """Hex encoded EWKB of a box as a MULTIPOLYGON, which postgres will accept as a geometry"""
+    ring = [(minx, miny), (minx, maxy), (maxx, maxy), (maxx, miny), (minx, miny)]
+    data = struct.pack("<BIII", 1, 0x20000006, srid, 1)
+    data += struct.pack("<BIII", 1, 3, 1, len(ring))
+    data += "".join(struct.pack("<dd", x, y) for x, y in ring)
+    return binascii.hexlify(data)
+
+
 class OSMStatsAggregator(object):
     top, bottom = 90, -90
     left, right = -180, 180
@@ -63,12 +167,52 @@ class OSMStatsAggregator(object):
     cut_land_boxes = True
     start_from_scratch = False
     rows_to_take = 100
+    workers = 1
+    set_based_grid = False
+    use_copy = False
+    properties_batch_size = 1000
+    processes = 1
+    raw_data_chunk_size = 10000
+    raw_data_layout = 'text'
+    raw_data_prefix = 'raw'
+    backend = 'postgis'
+    input_file = None
+    land_file = None
+    output_file = None
+    vectorised = False
+    changes_table = None
+    changes_file = None
+    pyramid_levels = 0
+    adaptive = False
+    min_increment = None
+    split_threshold = 100
+    output_sink = None
+    sink_only = False
+    progress_file = None
+    explain = False
+    land_cache = False
+    land_cache_table = "osmstataggregator_land_cache"
+    subdivide_land = None
+    version_trigger = False
+    coordinator = False
+    worker = False
+    tile_size = None
+    lease_seconds = 600
+    max_tile_attempts = 3
+    # SQL condition for which output rows to work on. Used to restrict a run to one tile
+    cell_scope = "TRUE"
+    pipeline = False
+    # Statistics which can be calculated in the database, see sql_statistic_sql
+    sql_statistics = None
+    use_sql_statistics = False
+    nearest_site = False
+    nearest_site_margin = 1.0
 
     internal_string_sep = "|"
 
-    def parse_args(self):
+    def parse_args(self, args=None):
         """
-        Parse command line options and figure out the settings
+        Parse command line options (or the list args) and figure out the settings
         """
         parser = argparse.ArgumentParser()
 
@@ -99,7 +243,60 @@ class OSMStatsAggregator(object):
 
         parser.add_argument('--recalculate-properties',action='store_true', default=False)
 
-        args = parser.parse_args()
+        parser.add_argument('--set-based-grid', action='store_true', default=self.set_based_grid, help="Generate the grid in the database with one query, rather than cell by cell")
+
+        parser.add_argument('--copy', dest='use_copy', action='store_true', default=self.use_copy, help="Use COPY for bulk loading grid cells and properties")
+
+        parser.add_argument('--properties-batch-size', type=int, default=self.properties_batch_size, help="How many rows of properties to write (and commit) at once")
+
+        parser.add_argument('--processes', type=int, default=self.processes, help="Number of processes to calculate properties with")
+
+        parser.add_argument('--raw-data-chunk-size', type=int, default=self.raw_data_chunk_size, help="How many ids to populate raw_data for (and commit) at once")
+
+        parser.add_argument('--raw-data-layout', default=self.raw_data_layout, choices=['text', 'arrays'], help="How to store the nearest neighbours. 'arrays' stores typed arrays, sorted by distance")
+
+        parser.add_argument('--workers', type=int, default=self.workers, help="Number of database connections to use in parallel, for land boxes & raw_data")
+
+        parser.add_argument('--vectorised', action='store_true', default=self.vectorised, help="Calculate properties for many cells at once, if the aggregator supports it (needs numpy)")
+
+        parser.add_argument('--changes-table', default=self.changes_table, type=str, help="Table of points (in the input geom column) where input data was added, removed or moved from/to. Only the cells affected by them are recalculated")
+        parser.add_argument('--changes-file', default=self.changes_file, type=str, help="CSV file (with lon & lat columns) of changed points, instead of --changes-table")
+
+        parser.add_argument('--pyramid-levels', type=int, default=self.pyramid_levels, help="Also make this many coarser levels (2x2, 4x4, ... cells merged) from the output table, in tables called OUTPUT_TABLE_levelN")
+
+        parser.add_argument('--adaptive', action='store_true', default=self.adaptive, help="Make a quadtree grid, starting with --increment sized cells, splitting cells with more than --split-threshold input points in them")
+        parser.add_argument('--min-increment', type=float, default=self.min_increment, help="Smallest cell size for --adaptive (default: increment/8)")
+        parser.add_argument('--split-threshold', type=int, default=self.split_threshold, help="Split a cell if it has more than this many input points, for --adaptive")
+
+        parser.add_argument('--output-sink', default=self.output_sink, type=str, help="Also write the results to this file as they're calculated. .gpkg for GeoPackage, .fgb for FlatGeobuf, .npy or .tif for a raster (regular grids only), otherwise newline delimited GeoJSON")
+        parser.add_argument('--sink-only', action='store_true', default=self.sink_only, help="Only write the properties to --output-sink, not to the output table")
+
+        parser.add_argument('--progress-file', default=self.progress_file, type=str, help="Append JSON lines progress & per-phase timing events to this file")
+        parser.add_argument('--explain', action='store_true', default=self.explain, help="Also record EXPLAIN (ANALYZE, BUFFERS) of the land & nearest neighbour queries as events")
+
+        parser.add_argument('--land-cache', action='store_true', default=self.land_cache, help="Reuse the land boxes from an earlier run with the same land, area, increment, srid & geometry type (from the {0} table), and save them there for later runs".format(self.land_cache_table))
+
+        parser.add_argument('--version-trigger', action='store_true', default=self.version_trigger, help="Add a trigger to the land table (once) which counts changes to it, so --land-cache & --subdivide-land can tell it's changed without checksumming the whole table")
+        parser.add_argument('--subdivide-land', type=int, default=self.subdivide_land, metavar="MAX_VERTICES", help="Use a copy of the land table with the polygons split into pieces of at most this many vertices (made, or remade if the land has changed, as LAND_TABLE_subdivided_N)")
+
+        parser.add_argument('--coordinator', action='store_true', default=self.coordinator, help="Split the area into tiles in a work queue table (OUTPUT_TABLE__tiles), wait for --worker processes to do them, then finish off")
+        parser.add_argument('--worker', action='store_true', default=self.worker, help="Take tiles from the work queue and calculate them, until there are none left. Run as many as you want, on any machine that can reach the database")
+        parser.add_argument('--tile-size', type=float, default=self.tile_size, help="Width & height of a tile, in degrees. Must be a multiple of the increment (default: 100 * increment)")
+        parser.add_argument('--lease-seconds', type=int, default=self.lease_seconds, help="A worker must finish each phase of a tile in this time, or the tile is given to another worker")
+
+        parser.add_argument('--pipeline', action='store_true', default=self.pipeline, help="Make the land boxes, raw data & properties at the same time, in batches which flow from one to the next, rather than one phase after the other")
+
+        parser.add_argument('--sql-statistics', dest='use_sql_statistics', action='store_true', default=self.use_sql_statistics, help="Calculate the properties in this aggregator's sql_statistics in the database, and only the rest in python")
+
+        parser.add_argument('--nearest-site', action='store_true', default=self.nearest_site, help="For aggregators whose properties are all 'closest' sql_statistics: look up each cell's nearest input point in a Voronoi diagram of the input (OUTPUT_TABLE__voronoi), rather than finding it's nearest neighbours")
+        parser.add_argument('--nearest-site-margin', type=float, default=self.nearest_site_margin, help="Only put input points within this distance (in the srid's units) of the area in the Voronoi diagram. Cells it doesn't cover are looked up directly (default %(default)s)")
+
+        parser.add_argument('--backend', default=self.backend, choices=['postgis', 'memory'], help="'memory' runs without a database, using the --*-file options")
+        parser.add_argument('--input-file', default=self.input_file, type=str, help="CSV (with lon & lat columns) or GeoJSON file of input points, for the memory backend")
+        parser.add_argument('--land-file', default=self.land_file, type=str, help="GeoJSON file of land polygons, for the memory backend")
+        parser.add_argument('--output-file', default=self.output_file, type=str, help="File to write to, for the memory backend. Same formats as --output-sink")
+
+        args = parser.parse_args(args)
 
         # Save to self
         self.__dict__.update(vars(args))
@@ -111,15 +308,138 @@ class OSMStatsAggregator(object):
         assert self.minlat < self.maxlat
         assert self.increment > 0
         assert self.rows_to_take >= 1
+        assert self.workers >= 1
+        assert self.properties_batch_size >= 1
+        assert self.processes >= 1
+        assert self.raw_data_chunk_size >= 1
+        assert self.pyramid_levels >= 0
+        if self.subdivide_land is not None:
+            # ST_Subdivide needs at least 5
+            assert self.subdivide_land >= 5
+        if self.sink_only:
+            assert self.output_sink
+        if self.output_sink:
+            # The changed cells are already in the sink, and would be written again
+            assert not (self.changes_table or self.changes_file), "--changes-table/--changes-file can't be used with --output-sink"
+        if self.adaptive:
+            # cells are different sizes, so they can't be stored as points
+            assert self.output_geom_type == 'polygon'
+            if self.min_increment is None:
+                self.min_increment = self.increment / 8
+            assert 0 < self.min_increment <= self.increment
+            assert self.split_threshold >= 1
+            # the cells depend on the input data too
+            assert not self.land_cache, "--land-cache can't be used with --adaptive"
+        if self.backend == 'memory':
+            assert self.input_file and self.land_file and self.output_file
+        if self.coordinator or self.worker:
+            if self.tile_size is None:
+                self.tile_size = self.increment * 100
+            # Tiles have to be made of whole cells
+            assert abs(round(self.tile_size / self.increment) * self.increment - self.tile_size) < 1e-9
+            assert self.lease_seconds > 0
+            assert not (self.changes_table or self.changes_file), "--changes-table/--changes-file aren't supported with tiles"
+            assert not self.output_sink, "--output-sink isn't supported with tiles"
+        if self.pipeline:
+            assert not (self.coordinator or self.worker), "--pipeline can't be used with tiles"
+            assert not (self.changes_table or self.changes_file), "--changes-table/--changes-file aren't supported with --pipeline"
+            assert not self.adaptive, "--adaptive isn't supported with --pipeline"
+        if self.use_sql_statistics:
+            assert self.sql_statistics, "This aggregator has no sql_statistics"
+            assert not self.pipeline, "--sql-statistics isn't supported with --pipeline"
+            # The sink gets the properties calculated in python
+            assert not self.output_sink, "--sql-statistics isn't supported with --output-sink"
+        if self.nearest_site:
+            assert self.sql_statistics and set(self.properties([])) <= set(self.sql_statistics), "--nearest-site needs every property to be in sql_statistics"
+            assert all(spec['kind'] in ('closest', 'constant') for spec in self.sql_statistics.values()), "--nearest-site can only do 'closest' & 'constant' statistics"
+            assert not (self.pipeline or self.coordinator or self.worker), "--nearest-site can't be used with --pipeline or tiles"
+            assert not (self.changes_table or self.changes_file), "--changes-table/--changes-file aren't needed with --nearest-site"
+            assert not self.output_sink, "--nearest-site isn't supported with --output-sink"
+            assert self.nearest_site_margin > 0
 
         self.land_table, self.land_geom_col = self.land.split(".")
+        # prepare_land() can change land_table to a subdivided copy of this
+        self.source_land_table = self.land_table
+
+        self.instrumentation = Instrumentation(self.progress_file, self.progress_event)
+
+    def progress_event(self, event):
+        """Called with every instrumentation event (a dict). Subclasses can override this to monitor a run"""
+        pass
+
+    def __getstate__(self):
+        # Database connections (and open files) can't be sent to other processes
+        state = self.__dict__.copy()
+        state.pop('conn', None)
+        state.pop('instrumentation', None)
+        return state
+
+    def new_connection(self):
+        """Open a new, separate, connection to the database"""
+        if getattr(self, 'instrumentation', None) is None:
+            self.instrumentation = Instrumentation()
+        conn = psycopg2.connect("dbname="+self.database, connection_factory=InstrumentedConnection)
+        # So the time spent in every query is recorded
+        conn.instrumentation = self.instrumentation
+        return conn
 
     def database_connection(self):
         if not hasattr(self, 'conn'):
-            self.conn = psycopg2.connect("dbname="+self.database)
+            self.conn = self.new_connection()
 
         return self.conn
 
+    def run_with_worker_connections(self, func, work_items):
+        """
+        Call func(conn, item) for every item in work_items, using self.workers
+        threads, each with its own database connection. func is responsible
+        for committing. Any exception in a worker is re-raised here.
+        """
+        work_queue = Queue.Queue(maxsize=self.workers * 2)
+        errors = []
+
+        def worker():
+            conn = None
+            try:
+                conn = self.new_connection()
+            except Exception as e:
+                # (e.g. too many connections) keep taking items, so the main thread doesn't block
+                errors.append(e)
+            try:
+                while True:
+                    item = work_queue.get()
+                    try:
+                        if item is None:
+                            return
+                        if not errors:
+                            func(conn, item)
+                    except Exception as e:
+                        conn.rollback()
+                        errors.append(e)
+                    finally:
+                        work_queue.task_done()
+            finally:
+                if conn is not None:
+                    conn.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        for item in work_items:
+            if errors:
+                break
+            work_queue.put(item)
+
+        for _ in threads:
+            work_queue.put(None)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
     def create_table(self):
         conn = self.database_connection()
         cursor = conn.cursor()
@@ -137,7 +457,8 @@ class OSMStatsAggregator(object):
             print "Table {output_table} already exists, not re-creating".format(output_table=self.output_table)
 
         else:
-            cursor.execute("CREATE TABLE {0} (id serial primary key, raw_data text[] default NULL, properties_calculated boolean DEFAULT FALSE);".format(self.output_table))
+            raw_data_column_defs = ", ".join("{0} {1} default NULL".format(name, type) for provider in self.raw_data_providers() for (name, type) in provider.raw_data_columns())
+            cursor.execute("CREATE TABLE {0} (id serial primary key, {1}, properties_calculated boolean DEFAULT FALSE);".format(self.output_table, raw_data_column_defs))
 
         # What columns are there?
         if table_exists:
@@ -146,18 +467,22 @@ class OSMStatsAggregator(object):
         else:
             existing_columns = []
 
-        possible_columns = self.properties([])
+        for provider in self.raw_data_providers():
+            if table_exists and provider.raw_data_check_col() not in existing_columns:
+                # table was made with a different --raw-data-layout (or input tables)
+                for (name, type) in provider.raw_data_columns():
+                    if name not in existing_columns:
+                        cursor.execute("ALTER TABLE {0} ADD COLUMN {1} {2} DEFAULT NULL;".format(self.output_table, name, type))
+                cursor.execute("create index {0}__null_{1} on {0} ({1}) where {1} IS NULL;".format(self.output_table, provider.raw_data_check_col()))
+
+        # With --sink-only the properties are never stored in the table
+        possible_columns = self.properties([]) if not self.sink_only else {}
         for column in sorted(possible_columns):
             if column not in existing_columns:
                 # we're adding a properties column, so we defintily need to recalculate
                 self.recalculate_properties = True
 
-                if type(possible_columns[column]) in [str, basestring, unicode]:
-                    cursor.execute("ALTER TABLE {0} ADD COLUMN {1} TEXT DEFAULT NULL;".format(self.output_table, column))
-                elif type(possible_columns[column]) in [int, float]:
-                    cursor.execute("ALTER TABLE {0} ADD COLUMN {1} REAL DEFAULT NULL;".format(self.output_table, column))
-                else:
-                    raise TypeError
+                cursor.execute("ALTER TABLE {0} ADD COLUMN {1} {2} DEFAULT NULL;".format(self.output_table, column, self.property_column_type(possible_columns[column])))
 
         if not table_exists:
             # Need to create the geom column
@@ -169,7 +494,8 @@ class OSMStatsAggregator(object):
                 raise ValueError
 
         if not table_exists:
-            cursor.execute("create index {0}__null_raw_data on {0} (raw_data) where raw_data IS NULL;".format(self.output_table))
+            for provider in self.raw_data_providers():
+                cursor.execute("create index {0}__null_{1} on {0} ({1}) where {1} IS NULL;".format(self.output_table, provider.raw_data_check_col()))
             cursor.execute("create index {0}__properties_calculated on {0} (properties_calculated);".format(self.output_table))
             cursor.execute("create index {0}__{1} on {0} using gist ({1});".format(self.output_table, self.output_geom_col))
 
@@ -177,21 +503,61 @@ class OSMStatsAggregator(object):
         cursor.close()
 
 
-    def generate_boxes(self):
+    def raw_data_columns(self):
+        """
+        List of (name, type) of the columns the raw data is stored in.
+
+        With the 'text' layout, each neighbour is one '|' separated string in
+        raw_data. With the 'arrays' layout, there's one typed array per input
+        column (plus the distances), already sorted by distance.
+        """
+        if self.raw_data_layout == 'text':
+            return [(self.raw_data_prefix + '_data', 'text[]')]
+        elif self.raw_data_layout == 'arrays':
+            return [(self.raw_data_prefix + '_distances', 'real[]')] + [(self.raw_data_prefix + '_' + col, 'text[]') for col in self.input_data_cols]
+        else:
+            raise ValueError("Unknown raw data layout " + self.raw_data_layout)
+
+    def raw_data_check_col(self):
+        """The raw data column that's NULL when the raw data hasn't been calculated"""
+        return self.raw_data_columns()[0][0]
 
-        num_lons = int((self.maxlon - self.minlon)/self.increment)
+    def raw_data_providers(self):
+        """
+        The aggregators whose raw data columns are in the output table. Just
+        this one, but a MultiAggregator has one per input table.
+        """
+        return [self]
+
+    def property_column_type(self, value):
+        """The postgres column type to store this (default) property value in"""
+        if type(value) in [str, basestring, unicode]:
+            return "TEXT"
+        elif type(value) in [int, float]:
+            return "REAL"
+        else:
+            raise TypeError
+
+    def generate_boxes(self):
+        """
+        Yield a dict for every cell in the grid. Positions are calculated from
+        the integer index (like grid_cells_sql), not by adding up increments,
+        so there is no float drift, and a sub-area (e.g. a tile) whose edges
+        are on the grid gets exactly the same cells as the whole area.
+        """
+        num_lons, num_lats = self.grid_shape()
         # at most 100 dots per line
         put_a_dot_every = max(int(num_lons / 100), 1)
 
-        for this_minlat in frange(self.minlat, self.maxlat, self.increment):
-            percent = ((this_minlat - self.minlat) / (self.maxlat - self.minlat) ) * 100
+        for y in range(num_lats):
+            this_minlat = self.minlat + y * self.increment
+            percent = (float(y) / num_lats) * 100
             sys.stdout.write("\n[%3d%%] %s " % (percent, this_minlat))
 
-            done_lons = 0
-            for this_minlon in frange(self.minlon, self.maxlon, self.increment):
-                if done_lons % put_a_dot_every == 0:
+            for x in range(num_lons):
+                if x % put_a_dot_every == 0:
                     sys.stdout.write(".")
-                done_lons += 1
+                this_minlon = self.minlon + x * self.increment
 
                 centre_lat = this_minlat + (self.increment/2)
                 centre_lon = this_minlon + (self.increment/2)
@@ -209,6 +575,12 @@ class OSMStatsAggregator(object):
                     raise TypeError
 
                 yield {
+                    'x': x,
+                    'y': y,
+                    'minlon': this_minlon,
+                    'minlat': this_minlat,
+                    'maxlon': this_maxlon,
+                    'maxlat': this_maxlat,
                     'box_wkt': bbox_wkt,
                     'point_wkt': point_wkt,
                     'geom_wkt': geom_wkt,
@@ -218,6 +590,459 @@ class OSMStatsAggregator(object):
                     'centre_x': centre_lon,
                 }
 
+    def grid_shape(self):
+        """Return (number of columns, number of rows) in the grid"""
+        # The small fudge is so that float error doesn't give us an extra row/col
+        num_lons = int(math.ceil(((self.maxlon - self.minlon) / self.increment) - 1e-9))
+        num_lats = int(math.ceil(((self.maxlat - self.minlat) / self.increment) - 1e-9))
+        return num_lons, num_lats
+
+    def grid_cells_sql(self):
+        """
+        SQL for a subquery which generates the whole grid in the database. Each
+        row has the integer cell index (x, y), the cell's box and it's centre point.
+        Positions are calculated from the integer index, so there is no float drift.
+        """
+        num_lons, num_lats = self.grid_shape()
+        query = """SELECT x, y,
+                ST_Multi(ST_MakeEnvelope({minlon} + x * {inc}, {minlat} + y * {inc}, {minlon} + (x + 1) * {inc}, {minlat} + (y + 1) * {inc}, {srid})) AS box,
+                ST_SetSRID(ST_Point({minlon} + (x + 0.5) * {inc}, {minlat} + (y + 0.5) * {inc}), {srid}) AS point
+            FROM generate_series(0, {max_x}) AS x, generate_series(0, {max_y}) AS y"""
+        return query.format(minlon=repr(float(self.minlon)), minlat=repr(float(self.minlat)),
+                            inc=repr(float(self.increment)), srid=self.srid,
+                            max_x=num_lons - 1, max_y=num_lats - 1)
+
+    def point_on_land_sql(self, point):
+        """SQL condition for point (an SQL expression) being on the land polygon in the current row of the land table"""
+        if self.subdivide_land:
+            # A point on the line between 2 pieces of a subdivided polygon isn't
+            # inside either of them (ST_Contains excludes the boundary)
+            return "ST_Intersects({land_table}.{land_col}, {point})".format(land_table=self.land_table, land_col=self.land_geom_col, point=point)
+        else:
+            return "ST_Contains({land_table}.{land_col}, {point})".format(land_table=self.land_table, land_col=self.land_geom_col, point=point)
+
+    def land_cut_sql(self, bbox):
+        """
+        SQL for a query which returns one row with the part of bbox (an SQL
+        expression) that's on land, or NULL if it's all sea.
+        """
+        query = """SELECT
+                ST_Multi(ST_Union(
+                    CASE
+                        WHEN ST_Within({bbox}, {land_table}.{land_col}) THEN {bbox}
+                        WHEN ST_Within({land_table}.{land_col}, {bbox}) THEN ST_Multi({land_table}.{land_col})
+                        WHEN
+                                ST_Intersects({land_table}.{land_col}, {bbox})
+                            THEN
+                                ST_CollectionExtract(ST_Multi(ST_Intersection({land_table}.{land_col}, {bbox})), 3)
+                        ELSE NULL
+                    END
+                )) AS geom
+                FROM
+                    {land_table} WHERE {land_col} && {bbox}"""
+        return query.format(land_table=self.land_table, land_col=self.land_geom_col, bbox=bbox)
+
+    def insert_land_boxes_set_based(self, db_cursor):
+        """
+        Generate the whole grid, and filter/cut it against the land, in one
+        INSERT ... SELECT. No per-cell python or SQL round trips.
+        """
+        if self.output_geom_type == 'point':
+            query = """INSERT INTO {output_table} ( {output_geom_col} )
+                SELECT cells.point FROM ({grid}) AS cells
+                WHERE EXISTS (SELECT 1 FROM {land_table} WHERE {point_on_land} LIMIT 1)
+                ORDER BY cells.y, cells.x;"""
+        elif self.output_geom_type == 'polygon' and not self.cut_land_boxes:
+            query = """INSERT INTO {output_table} ( {output_geom_col} )
+                SELECT cells.box FROM ({grid}) AS cells
+                WHERE EXISTS (SELECT 1 FROM {land_table} WHERE {land_table}.{land_col} && cells.box LIMIT 1)
+                ORDER BY cells.y, cells.x;"""
+        elif self.output_geom_type == 'polygon':
+            query = """INSERT INTO {output_table} ( {output_geom_col} )
+                SELECT cut.geom FROM ({grid}) AS cells, LATERAL ({land_cut}) AS cut
+                WHERE cut.geom IS NOT NULL
+                ORDER BY cells.y, cells.x;"""
+        else:
+            raise TypeError
+
+        query = query.format(output_table=self.output_table, output_geom_col=self.output_geom_col,
+                             land_table=self.land_table, land_col=self.land_geom_col,
+                             grid=self.grid_cells_sql(), land_cut=self.land_cut_sql("cells.box"),
+                             point_on_land=self.point_on_land_sql("cells.point"))
+        print "Generating land boxes in the database..."
+        db_cursor.execute(query)
+        print "done."
+
+    def insert_land_boxes_adaptive(self, db_cursor):
+        """
+        Generate a quadtree grid. Start with the normal grid (of cells on land),
+        then repeatedly split any cell with more than split_threshold input
+        points into 4, until the cells would be smaller than min_increment.
+        """
+        quadtree_table = self.output_table + "__quadtree"
+        query = """CREATE TEMPORARY TABLE {quadtree_table} AS
+            SELECT cells.box, {inc}::float8 AS size, FALSE AS split FROM ({grid}) AS cells
+            WHERE EXISTS (SELECT 1 FROM {land_table} WHERE {land_table}.{land_col} && cells.box LIMIT 1);"""
+        db_cursor.execute(query.format(quadtree_table=quadtree_table, inc=repr(float(self.increment)), grid=self.grid_cells_sql(),
+                                       land_table=self.land_table, land_col=self.land_geom_col))
+
+        size = float(self.increment)
+        while size / 2 >= self.min_increment:
+            # Only need to count up to the threshold
+            query = """UPDATE {quadtree_table} SET split = (
+                    SELECT count(*) FROM (SELECT 1 FROM {input_data_table} WHERE {input_data_table}.{input_geom_col} && {quadtree_table}.box LIMIT {threshold} + 1) AS inside
+                ) > {threshold}
+                WHERE size = %s;"""
+            db_cursor.execute(query.format(quadtree_table=quadtree_table, input_data_table=self.input_data_table,
+                                           input_geom_col=self.input_geom_col, threshold=self.split_threshold), [size])
+
+            query = """INSERT INTO {quadtree_table} (box, size, split)
+                SELECT children.box, %s, FALSE FROM (
+                    SELECT ST_Multi(ST_MakeEnvelope(ST_XMin(box) + dx * %s, ST_YMin(box) + dy * %s, ST_XMin(box) + (dx + 1) * %s, ST_YMin(box) + (dy + 1) * %s, {srid})) AS box
+                    FROM {quadtree_table}, generate_series(0, 1) AS dx, generate_series(0, 1) AS dy
+                    WHERE split
+                    ) AS children
+                WHERE EXISTS (SELECT 1 FROM {land_table} WHERE {land_table}.{land_col} && children.box LIMIT 1);"""
+            half = size / 2
+            db_cursor.execute(query.format(quadtree_table=quadtree_table, srid=self.srid,
+                                           land_table=self.land_table, land_col=self.land_geom_col), [half, half, half, half, half])
+            db_cursor.execute("DELETE FROM {0} WHERE split;".format(quadtree_table))
+            print "Split {0} cells into {1} sized cells".format(db_cursor.rowcount, half)
+
+            size = half
+
+        if self.cut_land_boxes:
+            query = """INSERT INTO {output_table} ( {output_geom_col} )
+                SELECT cut.geom FROM {quadtree_table}, LATERAL ({land_cut}) AS cut
+                WHERE cut.geom IS NOT NULL;"""
+        else:
+            query = "INSERT INTO {output_table} ( {output_geom_col} ) SELECT box FROM {quadtree_table};"
+        db_cursor.execute(query.format(output_table=self.output_table, output_geom_col=self.output_geom_col,
+                                       quadtree_table=quadtree_table, land_cut=self.land_cut_sql(quadtree_table + ".box")))
+        db_cursor.execute("DROP TABLE {0};".format(quadtree_table))
+
+    def generate_box_bands(self):
+        """Group the output of generate_boxes into lists, one per latitude band"""
+        for minlat, boxes in itertools.groupby(self.generate_boxes(), key=lambda b: b['minlat']):
+            yield list(boxes)
+
+    def prepare_land_box_statements(self, db_cursor):
+        """
+        PREPARE a 'land_box' statement on this connection, which takes the
+        minlon, minlat, maxlon, maxlat of a box and inserts the land part of
+        it (if any) into the output table. It returns the new row's id.
+        """
+        bbox = "ST_Multi(ST_MakeEnvelope($1, $2, $3, $4, {srid}))".format(srid=self.srid)
+        if self.output_geom_type == 'point':
+            query = """PREPARE land_box (float8, float8, float8, float8) AS
+                INSERT INTO {output_table} ( {output_geom_col} )
+                SELECT cell.point FROM (SELECT ST_SetSRID(ST_Point(($1 + $3) / 2, ($2 + $4) / 2), {srid}) AS point) AS cell
+                WHERE EXISTS (SELECT 1 FROM {land_table} WHERE {point_on_land} LIMIT 1)
+                RETURNING id;"""
+        elif not self.cut_land_boxes:
+            query = """PREPARE land_box (float8, float8, float8, float8) AS
+                INSERT INTO {output_table} ( {output_geom_col} )
+                SELECT {bbox} WHERE EXISTS (SELECT 1 FROM {land_table} WHERE {land_col} && {bbox} LIMIT 1)
+                RETURNING id;"""
+        else:
+            query = """PREPARE land_box (float8, float8, float8, float8) AS
+                INSERT INTO {output_table} ( {output_geom_col} )
+                SELECT geom FROM ({land_cut}) AS cut
+                WHERE geom IS NOT NULL
+                RETURNING id;"""
+
+        query = query.format(output_table=self.output_table, output_geom_col=self.output_geom_col,
+                             land_table=self.land_table, land_col=self.land_geom_col, bbox=bbox, srid=self.srid,
+                             land_cut=self.land_cut_sql(bbox), point_on_land=self.point_on_land_sql("cell.point"))
+        db_cursor.execute(query)
+
+    def insert_land_box_band(self, conn, band):
+        """Insert the land boxes for one latitude band, and commit"""
+        db_cursor = conn.cursor()
+        db_cursor.execute("SELECT 1 FROM pg_prepared_statements WHERE name = 'land_box';")
+        if len(db_cursor.fetchall()) == 0:
+            self.prepare_land_box_statements(db_cursor)
+
+        for bbox in band:
+            db_cursor.execute("EXECUTE land_box (%s, %s, %s, %s);", [bbox['minlon'], bbox['minlat'], bbox['maxlon'], bbox['maxlat']])
+        self.record_land_band(db_cursor, band)
+
+        conn.commit()
+        db_cursor.close()
+
+    def land_bands_table(self):
+        return self.output_table + "__land_bands"
+
+    def start_land_bands(self, db_cursor):
+        """
+        Make the table which records which latitude bands have been inserted.
+        It only exists while the bands are being done, so if it's there when
+        we start, the last run was interrupted part way through.
+        """
+        if self.cell_scope == "TRUE":
+            db_cursor.execute("CREATE TABLE IF NOT EXISTS {0} (band INTEGER PRIMARY KEY);".format(self.land_bands_table()))
+
+    def record_land_band(self, db_cursor, band):
+        """Record that this band is done, in the same transaction as it's cells"""
+        if self.cell_scope == "TRUE":
+            db_cursor.execute("INSERT INTO {0} (band) VALUES (%s);".format(self.land_bands_table()), [band[0]['y']])
+
+    def finish_land_bands(self, db_cursor):
+        db_cursor.execute("DROP TABLE IF EXISTS {0};".format(self.land_bands_table()))
+
+    def finished_land_bands(self, db_cursor):
+        """
+        The set of bands that are done, if the land boxes were being inserted
+        band by band and that was interrupted. None if they weren't.
+        """
+        db_cursor.execute("SELECT to_regclass(%s);", [self.land_bands_table()])
+        if db_cursor.fetchall()[0][0] is None:
+            return None
+        db_cursor.execute("SELECT band FROM {0};".format(self.land_bands_table()))
+        return set(row[0] for row in db_cursor.fetchall())
+
+    def remaining_land_bands(self, finished):
+        """generate_box_bands, without the bands in finished"""
+        return (band for band in self.generate_box_bands() if band[0]['y'] not in finished)
+
+    def delete_non_land_points(self, db_cursor):
+        print "\nRemoving non-land points..."
+        point = "{output_table}.{output_geom_col}".format(output_table=self.output_table, output_geom_col=self.output_geom_col)
+        query = "delete from {output_table} where not exists (select 1 from {land_table} where {point_on_land} limit 1) and ({cell_scope});".format(output_table=self.output_table, land_table=self.land_table, point_on_land=self.point_on_land_sql(point), cell_scope=self.cell_scope)
+        db_cursor.execute(query)
+        print "removed."
+
+    def copy_land_boxes(self, db_cursor):
+        """
+        COPY every grid cell into the output table as EWKB, then remove (or cut)
+        the ones that aren't on land with set based queries.
+        """
+        if self.output_geom_type == 'point':
+            cells = ((ewkb_point(b['centre_lon'], b['centre_lat'], self.srid),) for b in self.generate_boxes())
+        elif self.output_geom_type == 'polygon':
+            cells = ((ewkb_box(b['minlon'], b['minlat'], b['maxlon'], b['maxlat'], self.srid),) for b in self.generate_boxes())
+        else:
+            raise TypeError
+
+        copy_rows(db_cursor, self.output_table, [self.output_geom_col], cells)
+
+        if self.output_geom_type == 'point':
+            self.delete_non_land_points(db_cursor)
+        elif not self.cut_land_boxes:
+            print "\nRemoving non-land boxes..."
+            query = "delete from {output_table} where not exists (select 1 from {land_table} where {land_table}.{land_col} && {output_table}.{output_geom_col} limit 1) and ({cell_scope});"
+            db_cursor.execute(query.format(output_table=self.output_table, land_table=self.land_table, land_col=self.land_geom_col, output_geom_col=self.output_geom_col, cell_scope=self.cell_scope))
+            print "removed."
+        else:
+            print "\nCutting boxes to the land..."
+            bbox = "{output_table}.{output_geom_col}".format(output_table=self.output_table, output_geom_col=self.output_geom_col)
+            query = "UPDATE {output_table} SET {output_geom_col} = ({land_cut}) WHERE {cell_scope};".format(output_table=self.output_table, output_geom_col=self.output_geom_col, land_cut=self.land_cut_sql(bbox), cell_scope=self.cell_scope)
+            db_cursor.execute(query)
+            db_cursor.execute("DELETE FROM {output_table} WHERE {output_geom_col} IS NULL;".format(output_table=self.output_table, output_geom_col=self.output_geom_col))
+            print "done."
+
+    def explain_land_query(self, db_cursor):
+        """Record the query plan for deciding if the cell in the middle of the area is on land"""
+        num_lons, num_lats = self.grid_shape()
+        minlon = self.minlon + (num_lons // 2) * self.increment
+        minlat = self.minlat + (num_lats // 2) * self.increment
+        bbox = "ST_Multi(ST_MakeEnvelope({0!r}, {1!r}, {2!r}, {3!r}, {4}))".format(minlon, minlat, minlon + self.increment, minlat + self.increment, self.srid)
+
+        if self.output_geom_type == 'point':
+            point = "ST_SetSRID(ST_Point({0!r}, {1!r}), {2})".format(minlon + self.increment / 2, minlat + self.increment / 2, self.srid)
+            query = "SELECT 1 FROM {land_table} WHERE {point_on_land} LIMIT 1".format(land_table=self.land_table, point_on_land=self.point_on_land_sql(point))
+        elif self.cut_land_boxes:
+            query = self.land_cut_sql(bbox)
+        else:
+            query = "SELECT 1 FROM {land_table} WHERE {land_col} && {bbox} LIMIT 1".format(land_table=self.land_table, land_col=self.land_geom_col, bbox=bbox)
+
+        self.instrumentation.explain(db_cursor, 'create_land_boxes', query)
+
+    def land_cache_key(self):
+        """Everything (except the land data itself) that decides which cells are on land"""
+        return json.dumps({
+            'land': self.land,
+            'bbox': [self.minlon, self.minlat, self.maxlon, self.maxlat],
+            'increment': self.increment,
+            'srid': self.srid,
+            'geom_type': self.output_geom_type,
+            'cut': self.output_geom_type == 'polygon' and self.cut_land_boxes,
+        }, sort_keys=True)
+
+    def version_sequence(self, table):
+        return table + "_osmstataggregator_version"
+
+    def create_version_trigger(self, db_cursor, table):
+        """
+        Add a statement trigger to table which calls nextval on it's own
+        sequence on every INSERT/UPDATE/DELETE/TRUNCATE. (A sequence rather
+        than a counter row, so concurrent writers don't wait for each other.)
+        """
+        query = """CREATE SEQUENCE IF NOT EXISTS {sequence};
+            CREATE OR REPLACE FUNCTION osmstataggregator_bump_version() RETURNS trigger AS $$
+            BEGIN
+                PERFORM nextval(TG_ARGV[0]::regclass);
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql;
+            CREATE TRIGGER osmstataggregator_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+                FOR EACH STATEMENT EXECUTE PROCEDURE osmstataggregator_bump_version({sequence_name});"""
+        sequence = self.version_sequence(table)
+        db_cursor.execute(query.format(table=table, sequence=sequence, sequence_name=psycopg2.extensions.adapt(sequence).getquoted()))
+
+    def has_version_trigger(self, db_cursor, table):
+        db_cursor.execute("SELECT 1 FROM pg_trigger WHERE tgrelid = %s::regclass AND tgname = 'osmstataggregator_version';", [table])
+        return len(db_cursor.fetchall()) > 0
+
+    def table_fingerprint(self, db_cursor, table, add_trigger=False):
+        """
+        Something that changes whenever the data in this table changes. If
+        the table has a version trigger (see create_version_trigger), that's
+        it's relfilenode & the trigger's sequence. Otherwise it's a checksum of
+        every row, which means reading the whole table. The trigger is only
+        added if add_trigger (i.e. with --version-trigger).
+        """
+        if add_trigger and not self.has_version_trigger(db_cursor, table):
+            # Only one process at a time adds it
+            db_cursor.execute("SELECT pg_advisory_xact_lock(hashtext('osmstataggregator_version_trigger'));")
+            if not self.has_version_trigger(db_cursor, table):
+                print "Adding a trigger to {0} to count it's changes".format(table)
+                self.create_version_trigger(db_cursor, table)
+
+        if self.has_version_trigger(db_cursor, table):
+            query = "SELECT 'version', c.relfilenode, s.last_value, s.is_called FROM pg_class c, {sequence} s WHERE c.oid = %s::regclass;"
+            db_cursor.execute(query.format(sequence=self.version_sequence(table)), [table])
+        else:
+            print "Checksumming {0} to tell if it's changed (--version-trigger makes this quicker)".format(table)
+            db_cursor.execute("SELECT 'checksum', count(*), sum(hashtext(t::text)::bigint) FROM {0} AS t;".format(table))
+        return hashlib.md5(json.dumps(db_cursor.fetchall()[0])).hexdigest()
+
+    def create_land_cache_tables(self, db_cursor):
+        db_cursor.execute("SELECT to_regclass(%s);", [self.land_cache_table + "_geoms"])
+        if db_cursor.fetchall()[0][0] is not None:
+            return
+        # IF NOT EXISTS can still fail if another process (e.g. a tile worker)
+        # creates them at the same time, so only one at a time does
+        db_cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", [self.land_cache_table])
+        query = """CREATE TABLE IF NOT EXISTS {land_cache_table} (
+                key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, num_lons INTEGER, num_lats INTEGER, bitmap BYTEA, created TIMESTAMP DEFAULT now()
+            );
+            CREATE TABLE IF NOT EXISTS {land_cache_table}_geoms (
+                key TEXT NOT NULL REFERENCES {land_cache_table} (key) ON DELETE CASCADE, n INTEGER NOT NULL, geom GEOMETRY, PRIMARY KEY (key, n)
+            );"""
+        db_cursor.execute(query.format(land_cache_table=self.land_cache_table))
+
+    def load_land_cache(self, db_cursor):
+        """
+        Insert the land boxes from the land cache, if they're there (and the
+        land hasn't changed since). Returns True if they were loaded.
+        """
+        self.create_land_cache_tables(db_cursor)
+        key = self.land_cache_key()
+        db_cursor.execute("SELECT fingerprint, num_lons, num_lats, bitmap FROM {0} WHERE key = %s;".format(self.land_cache_table), [key])
+        rows = db_cursor.fetchall()
+        if len(rows) == 0:
+            return False
+
+        fingerprint, num_lons, num_lats, bitmap = rows[0]
+        if fingerprint != self.table_fingerprint(db_cursor, self.source_land_table, add_trigger=self.version_trigger):
+            print "Land table {0} has changed, not using the land cache".format(self.source_land_table)
+            db_cursor.execute("DELETE FROM {0} WHERE key = %s;".format(self.land_cache_table), [key])
+            return False
+
+        print "Loading land boxes from the land cache..."
+        if bitmap is None:
+            # cut boxes are stored as they are
+            query = """INSERT INTO {output_table} ( {output_geom_col} )
+                SELECT geom FROM {land_cache_table}_geoms WHERE key = %s ORDER BY n;"""
+            db_cursor.execute(query.format(output_table=self.output_table, output_geom_col=self.output_geom_col, land_cache_table=self.land_cache_table), [key])
+        else:
+            copy_rows(db_cursor, self.output_table, [self.output_geom_col], self.cells_from_bitmap(bytearray(bitmap), num_lons))
+        print "done."
+        return True
+
+    def cells_from_bitmap(self, bitmap, num_lons):
+        """Yield a (EWKB geometry,) row for each cell set in bitmap (one bit per cell, x + y * num_lons)"""
+        inc = self.increment
+        for byte_index, byte in enumerate(bitmap):
+            if byte == 0:
+                continue
+            for bit in range(8):
+                if byte & (1 << bit):
+                    y, x = divmod(byte_index * 8 + bit, num_lons)
+                    minlon, minlat = self.minlon + x * inc, self.minlat + y * inc
+                    if self.output_geom_type == 'point':
+                        yield (ewkb_point(minlon + inc / 2, minlat + inc / 2, self.srid),)
+                    else:
+                        yield (ewkb_box(minlon, minlat, minlon + inc, minlat + inc, self.srid),)
+
+    def save_land_cache(self, db_cursor):
+        """Store the land boxes that are in the output table in the land cache"""
+        self.create_land_cache_tables(db_cursor)
+        key = self.land_cache_key()
+        fingerprint = self.table_fingerprint(db_cursor, self.source_land_table, add_trigger=self.version_trigger)
+        num_lons, num_lats = self.grid_shape()
+        db_cursor.execute("DELETE FROM {0} WHERE key = %s;".format(self.land_cache_table), [key])
+
+        if self.output_geom_type == 'polygon' and self.cut_land_boxes:
+            db_cursor.execute("INSERT INTO {0} (key, fingerprint, num_lons, num_lats) VALUES (%s, %s, %s, %s);".format(self.land_cache_table), [key, fingerprint, num_lons, num_lats])
+            query = """INSERT INTO {land_cache_table}_geoms (key, n, geom)
+                SELECT %s, row_number() OVER (ORDER BY id), {output_geom_col} FROM {output_table} WHERE {cell_scope};"""
+            db_cursor.execute(query.format(land_cache_table=self.land_cache_table, output_table=self.output_table, output_geom_col=self.output_geom_col, cell_scope=self.cell_scope), [key])
+        else:
+            # The centre of a point or uncut box cell tells us it's index
+            bitmap = bytearray((num_lons * num_lats + 7) // 8)
+            query = """SELECT floor((ST_X(ST_Centroid({output_geom_col})) - {minlon!r}) / {inc!r})::int, floor((ST_Y(ST_Centroid({output_geom_col})) - {minlat!r}) / {inc!r})::int
+                FROM {output_table} WHERE {cell_scope};"""
+            db_cursor.execute(query.format(output_table=self.output_table, output_geom_col=self.output_geom_col, cell_scope=self.cell_scope,
+                                           minlon=float(self.minlon), minlat=float(self.minlat), inc=float(self.increment)))
+            for x, y in db_cursor:
+                if 0 <= x < num_lons and 0 <= y < num_lats:
+                    index = x + y * num_lons
+                    bitmap[index >> 3] |= 1 << (index & 7)
+            query = "INSERT INTO {0} (key, fingerprint, num_lons, num_lats, bitmap) VALUES (%s, %s, %s, %s, %s);".format(self.land_cache_table)
+            db_cursor.execute(query, [key, fingerprint, num_lons, num_lats, psycopg2.Binary(str(bitmap))])
+
+        print "Saved land boxes to the land cache"
+
+    def prepare_land(self):
+        """
+        With --subdivide-land, make sure there is an up to date subdivided copy
+        of the land table (with a spatial index), and use that from now on.
+        The small pieces have small bboxes, so the index finds only the pieces
+        near a cell, and each ST_Contains/ST_Intersection has few vertices.
+        The source table's fingerprint is stored in the copy's COMMENT, to
+        tell if it needs to be remade.
+        """
+        if not self.subdivide_land:
+            return
+
+        conn = self.database_connection()
+        db_cursor = conn.cursor()
+        subdivided_table = "{0}_subdivided_{1}".format(self.source_land_table, self.subdivide_land)
+        fingerprint = self.table_fingerprint(db_cursor, self.source_land_table, add_trigger=self.version_trigger)
+        # (in case the version trigger was just added)
+        conn.commit()
+
+        # The coordinator & tile workers all do this, only one at a time
+        # checks & rebuilds it, and the rest then see it's up to date
+        db_cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", [subdivided_table])
+        db_cursor.execute("SELECT obj_description(to_regclass(%s), 'pg_class');", [subdivided_table])
+        if db_cursor.fetchall()[0][0] != fingerprint:
+            print "Subdividing {0} into {1}...".format(self.source_land_table, subdivided_table)
+            query = """DROP TABLE IF EXISTS {subdivided_table};
+                CREATE TABLE {subdivided_table} AS SELECT ST_Subdivide({land_col}, {max_vertices}) AS {land_col} FROM {land_table};
+                CREATE INDEX {subdivided_table}__{land_col} ON {subdivided_table} USING gist ({land_col});"""
+            db_cursor.execute(query.format(subdivided_table=subdivided_table, land_table=self.source_land_table,
+                                           land_col=self.land_geom_col, max_vertices=self.subdivide_land))
+            db_cursor.execute("COMMENT ON TABLE {0} IS %s;".format(subdivided_table), [fingerprint])
+            db_cursor.execute("ANALYZE {0};".format(subdivided_table))
+            print "done."
+        conn.commit()
+
+        self.land_table = subdivided_table
+        db_cursor.close()
+
     def create_land_boxes(self):
         conn = self.database_connection()
         db_cursor = conn.cursor()
@@ -226,31 +1051,72 @@ class OSMStatsAggregator(object):
         db_cursor.execute(query)
         rows = db_cursor.fetchall()
         if len(rows) > 0:
+            finished = self.finished_land_bands(db_cursor)
+            if finished is not None:
+                # A previous run was killed part way through the bands
+                print "Table {0} has {1} latitude bands of land boxes, doing the rest".format(self.output_table, len(finished))
+                self.run_with_worker_connections(self.insert_land_box_band, self.remaining_land_bands(finished))
+                self.finish_land_bands(db_cursor)
+                conn.commit()
+                db_cursor.close()
+                return
+
             # There are rows in this table, ergo, don't re-create the land boxes
             print "Table {output_table} already has rows, not re-creating land boxes".format(output_table=self.output_table)
             return
 
+        # Left from a run that stopped before any band with land was done
+        self.finish_land_bands(db_cursor)
+        conn.commit()
+        db_cursor.close()
+        self.insert_land_boxes(conn)
+
+    def insert_land_boxes(self, conn):
+        """Insert the cells on land in the area (minlon etc.) into the output table, and commit"""
+        db_cursor = conn.cursor()
+
+        if self.land_cache and self.load_land_cache(db_cursor):
+            conn.commit()
+            db_cursor.close()
+            return
+
+        if self.explain:
+            self.explain_land_query(db_cursor)
+
         # TODO point & polygon-non-cut seem to be doing the same thing, maybe merge?
 
-        if self.output_geom_type == 'point':
+        if self.adaptive:
+            self.insert_land_boxes_adaptive(db_cursor)
+
+        elif self.set_based_grid:
+            self.insert_land_boxes_set_based(db_cursor)
+
+        elif self.use_copy:
+            self.copy_land_boxes(db_cursor)
+
+        elif self.output_geom_type == 'point':
             ## For points, we first put all the points in the DB
 
             # dodgy string joining for SQL here. Here be dragons. need it cause we need postgres to evaluate the function calls
             query_prefix = "INSERT INTO {output_table} ( {output_geom_col} ) VALUES ".format(output_table=self.output_table, output_geom_col=self.output_geom_col)
             
             # INSERT in batches of 10,000 which seems to work OK.
-            # shame we can't use COPY here
+            # (use --copy to COPY them in instead)
             for bbox_groups in batch(self.generate_boxes(), 10000):
                 query = query_prefix + ", ".join("("+x['point_wkt']+")" for x in bbox_groups) + ";"
                 db_cursor.execute(query)
 
             ## ... then we remove the ones that aren't on the ground
-            print "\nRemoving non-land points..."
-            query = "delete from {output_table} where not exists (select 1 from {land_table} where ST_Contains({land_table}.{land_col}, {output_table}.{output_geom_col}) limit 1);".format(output_table=self.output_table, land_table=self.land_table, land_col=self.land_geom_col, output_geom_col=self.output_geom_col)
-            db_cursor.execute(query)
-            print "removed."
+            self.delete_non_land_points(db_cursor)
+
 
 
+        elif self.output_geom_type == 'polygon' and self.workers > 1:
+            # Each latitude band is done in a separate connection, and committed on it's own
+            self.start_land_bands(db_cursor)
+            conn.commit()
+            self.run_with_worker_connections(self.insert_land_box_band, self.generate_box_bands())
+            self.finish_land_bands(db_cursor)
 
         elif self.output_geom_type == 'polygon':
             for bbox in self.generate_boxes():
@@ -299,50 +1165,302 @@ class OSMStatsAggregator(object):
                 query = "INSERT INTO {output_table} ( {output_geom_col} ) VALUES ( {bbox} );".format(output_table=self.output_table, output_geom_col=self.output_geom_col, bbox=bbox['geom'])
                 db_cursor.execute(query)
 
+        if self.land_cache:
+            self.save_land_cache(db_cursor)
+
         conn.commit()
         db_cursor.close()
 
-    def populate_raw_data(self):
-        """
-        For each of the points, populate the raw_data column with the closest raw data
-        """
-        conn = self.database_connection()
-        db_cursor = conn.cursor()
-
+    def output_geom_as_point_sql(self):
+        """SQL expression for the point of each output row that we measure distances from"""
         if self.output_geom_type == 'polygon':
-            output_geom_as_point = "ST_Centroid(ST_Box2d({output_table}.{output_geom_col}))".format(output_table=self.output_table, output_geom_col=self.output_geom_col)
+            return "ST_Centroid(ST_Box2d({output_table}.{output_geom_col}))".format(output_table=self.output_table, output_geom_col=self.output_geom_col)
         elif self.output_geom_type == 'point':
             # already a point
-            output_geom_as_point = self.output_table+"."+self.output_geom_col
+            return self.output_table+"."+self.output_geom_col
         else:
             raise TypeError
-        
-        data_cols = (", "+repr(self.internal_string_sep)+", ").join(self.input_data_cols)
-
-        # do
-        query = """update
-                        {output_table}
-                    set raw_data = (
-                        select array(select
-                            CONCAT(
-                                ST_Distance_Sphere({input_data_table}.{input_geom_col}, {output_geom_as_point})::text,
-                                {internal_string_sep!r},
-                                {data_cols}
-                                )
-                            from {input_data_table} order by {input_data_table}.{input_geom_col}<->{output_geom_as_point}
-                            limit {limit}
-                            ))
-                    where raw_data IS NULL;"""
-        query = query.format(
+
+    def neighbour_requirements(self):
+        """
+        What neighbours properties() needs, as a list of (k, radius), one for
+        each statistic: the nearest k neighbours (None for rows_to_take)
+        which are within radius metres (None for any distance). Only
+        neighbours which at least one statistic needs are fetched & stored.
+        None (the default) means all rows_to_take neighbours are needed.
+        """
+        return None
+
+    def neighbour_limits(self):
+        """
+        Return (the most neighbours to fetch, SQL condition on a neighbour's
+        rank 'rn' & 'distance' for it being needed or None if all are, the
+        largest radius in metres or None if there isn't one)
+        """
+        requirements = self.neighbour_requirements()
+        if not requirements:
+            return self.rows_to_take, None, None
+
+        requirements = [(min(k or self.rows_to_take, self.rows_to_take), radius) for (k, radius) in requirements]
+        limit = max(k for (k, radius) in requirements)
+        if any(k == limit and radius is None for (k, radius) in requirements):
+            # Everything we fetch is needed
+            return limit, None, None
+        needed = " OR ".join("(rn <= {0}{1})".format(k, "" if radius is None else " AND distance <= {0!r}".format(float(radius))) for (k, radius) in requirements)
+        if any(radius is None for (k, radius) in requirements):
+            max_radius = None
+        else:
+            max_radius = max(radius for (k, radius) in requirements)
+        return limit, needed, max_radius
+
+    def metres_to_degrees(self, metres):
+        """
+        A distance in degrees which is at least this many metres everywhere
+        within that distance of the cells (for bbox filters), i.e. at the
+        latitude nearest the pole that that could be
+        """
+        # (the last cells can stick out an increment past the area)
+        furthest_lat = min(max(abs(self.minlat), abs(self.maxlat)) + self.increment + metres / METRES_PER_DEGREE, 89)
+        return metres / METRES_PER_DEGREE / math.cos(math.radians(furthest_lat))
+
+    def metres_to_degrees_sql(self, metres, point):
+        """
+        SQL for a distance in degrees which is at least metres (SQL) anywhere
+        within that many metres of point (SQL), i.e. at the latitude nearest
+        the pole (for bbox filters, and comparing with <-> & ST_Distance)
+        """
+        return "({metres}) / {per_degree!r} / cos(radians(least(abs(ST_Y({point})) + ({metres}) / {per_degree!r}, 89)))".format(metres=metres, point=point, per_degree=METRES_PER_DEGREE)
+
+    def raw_data_update_sql(self, where="TRUE"):
+        """
+        SQL to populate raw_data for rows which don't have it yet, and also
+        match the where SQL fragment.
+        """
+        limit, needed, max_radius = self.neighbour_limits()
+        if max_radius is None:
+            prefilter = ""
+        else:
+            # Only look at input points which could be close enough, with the spatial index
+            prefilter = " where {input_data_table}.{input_geom_col} && ST_Expand({output_geom_as_point}, {degrees!r})".format(
+                input_data_table=self.input_data_table, input_geom_col=self.input_geom_col,
+                output_geom_as_point=self.output_geom_as_point_sql(), degrees=self.metres_to_degrees(max_radius))
+
+        if self.raw_data_layout == 'text' and needed is not None:
+            data_cols = (", "+repr(self.internal_string_sep)+", ").join(self.input_data_cols)
+            aggregates = ""
+
+            # Rank the nearest by distance, and keep the ones that are needed
+            query = """update
+                            {output_table}
+                        set {check_col} = (
+                            select array(select value from (
+                                select knn.*, row_number() OVER (ORDER BY distance) AS rn from (
+                                    select
+                                        CONCAT(
+                                            ST_Distance_Sphere({input_data_table}.{input_geom_col}, {output_geom_as_point})::text,
+                                            {internal_string_sep!r},
+                                            {data_cols}
+                                            ) AS value,
+                                        ST_Distance_Sphere({input_data_table}.{input_geom_col}, {output_geom_as_point}) AS distance
+                                    from {input_data_table}{prefilter} order by {input_data_table}.{input_geom_col}<->{output_geom_as_point}
+                                    limit {limit}
+                                    ) AS knn
+                                ) AS ranked
+                                where {needed}
+                                order by rn
+                                ))
+                        where {check_col} IS NULL AND ({where});"""
+        elif self.raw_data_layout == 'text':
+            data_cols = (", "+repr(self.internal_string_sep)+", ").join(self.input_data_cols)
+            aggregates = ""
+
+            query = """update
+                            {output_table}
+                        set {check_col} = (
+                            select array(select
+                                CONCAT(
+                                    ST_Distance_Sphere({input_data_table}.{input_geom_col}, {output_geom_as_point})::text,
+                                    {internal_string_sep!r},
+                                    {data_cols}
+                                    )
+                                from {input_data_table}{prefilter} order by {input_data_table}.{input_geom_col}<->{output_geom_as_point}
+                                limit {limit}
+                                ))
+                        where {check_col} IS NULL AND ({where});"""
+        elif self.raw_data_layout == 'arrays':
+            # NULL tags are '' like in the text layout (CONCAT drops NULLs)
+            data_cols = "".join(", COALESCE({input_data_table}.{col}::text, '') AS data_{i}".format(input_data_table=self.input_data_table, col=col, i=i) for i, col in enumerate(self.input_data_cols))
+            # Every array is ordered by the same rank, so they line up even when distances are tied
+            aggregates = "".join(", COALESCE(array_agg(data_{i} ORDER BY rn), '{{}}')".format(i=i) for i in range(len(self.input_data_cols)))
+
+            nearest = """select
+                                    ST_Distance_Sphere({input_data_table}.{input_geom_col}, {output_geom_as_point}) AS distance
+                                    {data_cols}
+                                from {input_data_table}{prefilter} order by {input_data_table}.{input_geom_col}<->{output_geom_as_point}
+                                limit {limit}"""
+            # Rank the nearest by distance once (and keep the ones that are needed)
+            nearest = "select * from (select knn.*, row_number() OVER (ORDER BY distance) AS rn from (" + nearest + ") AS knn) AS ranked"
+            if needed is not None:
+                nearest += " where {needed}"
+
+            query = """update
+                            {output_table}
+                        set ({raw_columns}) = (
+                            select COALESCE(array_agg(distance ORDER BY rn), '{{}}'){aggregates}
+                            from (""" + nearest + """
+                                ) AS nearest
+                            )
+                        where {check_col} IS NULL AND ({where});"""
+        else:
+            raise ValueError("Unknown raw data layout " + self.raw_data_layout)
+
+        return query.format(aggregates=aggregates,
             output_table=self.output_table, input_data_table=self.input_data_table, input_geom_col=self.input_geom_col,
-            data_cols = data_cols, output_geom_as_point=output_geom_as_point,
-            limit=self.rows_to_take, internal_string_sep=self.internal_string_sep,
+            data_cols = data_cols, output_geom_as_point=self.output_geom_as_point_sql(),
+            limit=limit, needed=needed, prefilter=prefilter, internal_string_sep=self.internal_string_sep, where=where,
+            raw_columns=", ".join(name for (name, type) in self.raw_data_columns()),
+            check_col=self.raw_data_check_col(),
         )
 
-        print "Calculating raw_data for each item..."
-        db_cursor.execute(query)
+    def populate_raw_data(self):
+        """
+        For each of the points, populate the raw_data column with the closest raw data.
+
+        This is done in chunks of ids, each committed on it's own, so it can be
+        interrupted and resumed. Chunks are run on self.workers connections.
+        """
+        conn = self.database_connection()
+        db_cursor = conn.cursor()
+
+        # Only the rows without raw_data need to be done, the partial index makes this quick
+        db_cursor.execute("SELECT min(id), max(id) FROM {output_table} WHERE {check_col} IS NULL AND ({cell_scope});".format(output_table=self.output_table, check_col=self.raw_data_check_col(), cell_scope=self.cell_scope))
+        min_id, max_id = db_cursor.fetchall()[0]
+        conn.commit()
+        db_cursor.close()
+
+        if min_id is None:
+            print "All rows already have raw_data"
+            return
+
+        chunks = [(start, min(start + self.raw_data_chunk_size, max_id + 1)) for start in xrange(min_id, max_id + 1, self.raw_data_chunk_size)]
+        query = self.raw_data_update_sql("id >= %s AND id < %s AND ({0})".format(self.cell_scope))
+
+        progress = {'done': 0, 'started': time.time()}
+        progress_lock = threading.Lock()
+
+        def populate_chunk(conn, chunk):
+            db_cursor = conn.cursor()
+            db_cursor.execute(query, chunk)
+            self.instrumentation.add_cells(db_cursor.rowcount)
+            conn.commit()
+            db_cursor.close()
+            with progress_lock:
+                progress['done'] += 1
+                print "Calculating raw_data " + progress_message(progress['done'], len(chunks), progress['started'])
+                self.instrumentation.progress(progress['done'], len(chunks), progress['started'])
+
+        if self.explain:
+            db_cursor = conn.cursor()
+            self.instrumentation.explain(db_cursor, 'populate_raw_data', query, chunks[0])
+            conn.commit()
+            db_cursor.close()
+
+        print "Calculating raw_data for ids {0}-{1} in {2} chunks...".format(min_id, max_id, len(chunks))
+        self.run_with_worker_connections(populate_chunk, chunks)
         print "done."
+
+    def neighbour_distance_sql(self, k):
+        """SQL expression for the distance to the k-th nearest neighbour in the raw data (NULL if there are fewer)"""
+        if self.raw_data_layout == 'text':
+            return "(SELECT split_part(neighbour, {sep!r}, 1)::float FROM unnest({output_table}.{check_col}) AS neighbour ORDER BY 1 OFFSET {offset} LIMIT 1)".format(sep=self.internal_string_sep, output_table=self.output_table, check_col=self.raw_data_check_col(), offset=k - 1)
+        elif self.raw_data_layout == 'arrays':
+            # already sorted
+            return "{output_table}.{check_col}[{k}]".format(output_table=self.output_table, check_col=self.raw_data_check_col(), k=k)
+        else:
+            raise ValueError("Unknown raw data layout " + self.raw_data_layout)
+
+    def change_radius_sql(self):
+        """
+        SQL expression for how near (in metres) a changed input point has to
+        be to a cell to change the neighbours it needs, or 'Infinity' if any
+        point would. The stored neighbours are always the nearest n (each
+        requirement keeps a prefix of them), so for each (k, radius)
+        requirement, a point matters if it's nearer than the k-th neighbour
+        (when there are k), and within the radius.
+        """
+        requirements = self.neighbour_requirements() or [(None, None)]
+        count = "COALESCE(array_length({output_table}.{check_col}, 1), 0)".format(output_table=self.output_table, check_col=self.raw_data_check_col())
+        radii = []
+        for k, radius in requirements:
+            k = min(k or self.rows_to_take, self.rows_to_take)
+            kth = self.neighbour_distance_sql(k)
+            if radius is None:
+                radii.append("CASE WHEN {count} >= {k} THEN {kth} ELSE 'Infinity'::float8 END".format(count=count, k=k, kth=kth))
+            else:
+                radii.append("CASE WHEN {count} >= {k} THEN least({radius!r}, {kth}) ELSE {radius!r} END".format(count=count, k=k, kth=kth, radius=float(radius)))
+        return "greatest({0})".format(", ".join(radii))
+
+    def mark_changed_cells(self):
+        """
+        Given a set of changed input points (--changes-table or --changes-file),
+        clear the raw data of every cell which could have a different set of
+        the neighbours it needs, i.e. cells where a changed point is within
+        change_radius_sql. populate_raw_data & calculate_properties will then
+        only redo those.
+        """
+        conn = self.database_connection()
+        db_cursor = conn.cursor()
+
+        if self.changes_file:
+            changes_table = self.output_table + "__changes"
+            db_cursor.execute("CREATE TEMPORARY TABLE {0} ({1} geometry);".format(changes_table, self.input_geom_col))
+            with open(self.changes_file) as fp:
+                points = ((ewkb_point(float(row['lon']), float(row['lat']), self.srid),) for row in csv.DictReader(fp))
+                copy_rows(db_cursor, changes_table, [self.input_geom_col], points)
+            db_cursor.execute("CREATE INDEX ON {0} USING gist ({1});".format(changes_table, self.input_geom_col))
+            db_cursor.execute("ANALYZE {0};".format(changes_table))
+        else:
+            changes_table = self.changes_table
+
+        check_col = self.raw_data_check_col()
+        clear_raw_data = ", ".join("{0} = NULL".format(name) for (name, type) in self.raw_data_columns())
+
+        # e.g. cells with fewer than k neighbours in total, which would include any new point
+        query = "UPDATE {output_table} SET {clear_raw_data}, properties_calculated = FALSE WHERE {check_col} IS NOT NULL AND {radius} = 'Infinity'::float8;"
+        db_cursor.execute(query.format(output_table=self.output_table, clear_raw_data=clear_raw_data, check_col=check_col, radius=self.change_radius_sql()))
+
+        # The neighbours were found with <->, i.e. by distance in degrees, so
+        # changes have to be tested that way too. A point within the radius
+        # (in metres on the sphere) of the cell is at most that radius in
+        # degrees at the latitude nearest the pole it could be at, so that's
+        # used as the distance in degrees (it can only mark a few extra
+        # cells). Each cell's distance is worked out once (the OFFSET 0 stops
+        # postgres inlining the subquery), then the changes near that cell
+        # are found with the spatial index on the changes table.
+        query = """UPDATE {output_table} SET {clear_raw_data}, properties_calculated = FALSE
+            WHERE id IN (
+                SELECT cells.id FROM (
+                    SELECT id, point, {degrees} AS degrees FROM (
+                        SELECT id, {output_geom_as_point} AS point, {radius} AS radius FROM {output_table} WHERE {check_col} IS NOT NULL OFFSET 0
+                        ) AS radii
+                    OFFSET 0
+                    ) AS cells
+                WHERE EXISTS (
+                    SELECT 1 FROM {changes_table}
+                    WHERE {changes_table}.{input_geom_col} && ST_Expand(cells.point, cells.degrees)
+                        AND ST_Distance({changes_table}.{input_geom_col}, cells.point) <= cells.degrees
+                    )
+                );"""
+        query = query.format(output_table=self.output_table, clear_raw_data=clear_raw_data, changes_table=changes_table,
+                             input_geom_col=self.input_geom_col, check_col=check_col,
+                             output_geom_as_point=self.output_geom_as_point_sql(), radius=self.change_radius_sql(),
+                             degrees=self.metres_to_degrees_sql("radius", "point"))
+        print "Marking cells affected by changes in {0}...".format(changes_table)
+        db_cursor.execute(query)
+        print "{0} cells marked.".format(db_cursor.rowcount)
+
         conn.commit()
+        db_cursor.close()
 
     def calculate_properties(self):
         """
@@ -354,42 +1472,506 @@ class OSMStatsAggregator(object):
         writing_cursor = conn.cursor()
 
         if self.recalculate_properties:
-            writing_cursor.execute("UPDATE {output_table} SET properties_calculated = FALSE WHERE properties_calculated IS TRUE;".format(output_table=self.output_table))
+            writing_cursor.execute("UPDATE {output_table} SET properties_calculated = FALSE WHERE properties_calculated IS TRUE AND ({cell_scope});".format(output_table=self.output_table, cell_scope=self.cell_scope))
 
-        writing_cursor.execute("ANALYZE {output_table};".format(output_table=self.output_table))
-        writing_cursor.execute("REINDEX INDEX {output_table}__properties_calculated;".format(output_table=self.output_table))
+        if self.cell_scope == "TRUE":
+            # (not when other tiles are being written to at the same time)
+            writing_cursor.execute("ANALYZE {output_table};".format(output_table=self.output_table))
+            writing_cursor.execute("REINDEX INDEX {output_table}__properties_calculated;".format(output_table=self.output_table))
         reading_cursor = conn.cursor()
-        query = "SELECT count(*) FROM {output_table} WHERE properties_calculated IS FALSE".format(output_table=self.output_table)
+        query = "SELECT count(*) FROM {output_table} WHERE properties_calculated IS FALSE AND ({cell_scope})".format(output_table=self.output_table, cell_scope=self.cell_scope)
         reading_cursor.execute(query)
         total = reading_cursor.fetchall()[0][0]
 
-        query = "SELECT id, raw_data FROM {output_table} WHERE properties_calculated IS FALSE AND raw_data IS NOT NULL".format(output_table=self.output_table)
+        conn.commit()
 
-        # Give it a name, so it'll use a server side cursor. This is more memory effecient for large results
-        reading_cursor = conn.cursor("reading_properties")
-        reading_cursor.execute(query)
-        for (id, raw_data) in percentage_printer(reading_cursor, msg="Calculating properties:", total=total):
-            # Raw data is an array of TEXT, each element is the distance to a point, and then the input data columns
-            # e.g. { '12|christian|catholic', '23|christian|', … }
-            # So split it into a 2d list of list. Would like to have a native postgres 2d array (e.g.g text[][]), but it couldn't work with the aggregates.
-            raw_data = [x.split(self.internal_string_sep, 1+len(self.input_data_cols)) for x in raw_data]
+        if self.use_sql_statistics:
+            self.calculate_sql_statistics()
+            if len(self.python_property_columns()) == 0:
+                # Nothing left for python to do
+                writing_cursor.close()
+                reading_cursor.close()
+                return
+
+        rows = self.rows_needing_properties(conn)
+        chunks = batch(percentage_printer(rows, msg="Calculating properties:", total=total), self.properties_batch_size)
+
+        pool = None
+        if self.processes > 1:
+            # Rows are read here, and sent in chunks to the worker processes,
+            # with only a few chunks waiting at any time
+            pool = multiprocessing.Pool(self.processes, _init_properties_worker, (self,))
+            results = bounded_imap(pool, _compute_properties_in_worker, chunks, self.processes * 2)
+        else:
+            results = itertools.imap(self.compute_properties, chunks)
 
-            # floatify the distance (first element)
-            raw_data = [[float(item[0])] + self.clean_row_data(item[1:]) for item in raw_data]
+        sink = None
+        if self.output_sink and total > 0:
+            sink = self.open_output_sink(writing_cursor)
 
-            # raw data not guarantted to be sorted by distance ascending, so do it here
-            raw_data.sort(key=lambda r:r[0])
+        started, done = time.time(), 0
+        try:
+            # Commit after every batch, so if we're killed, we can resume from properties_calculated
+            for results_batch in results:
+                self.save_properties(writing_cursor, sink, results_batch)
+                if sink is not None:
+                    # so nothing marked as done is missing from the sink
+                    sink.flush()
+                conn.commit()
 
-            properties = self.properties(raw_data)
-            properties = [(k, properties[k]) for k in sorted(properties.keys())]
-            query = ("UPDATE {output_table} SET properties_calculated = TRUE, " + ", ".join(k+" = %s" for k, v in properties) + " WHERE id = {id};").format(output_table=self.output_table, id=id)
-            writing_cursor.execute(query, [v for k, v in properties])
+                done += len(results_batch)
+                self.instrumentation.add_cells(len(results_batch))
+                self.instrumentation.progress(done, total, started)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if sink is not None:
+                sink.close()
 
         writing_cursor.close()
         reading_cursor.close()
 
 
 
+    def python_property_columns(self):
+        """The property columns which are calculated in python, i.e. all of them, except the sql_statistics with --sql-statistics"""
+        columns = sorted(self.properties([]).keys())
+        if self.use_sql_statistics:
+            columns = [k for k in columns if k not in self.sql_statistics]
+        return columns
+
+    def neighbours_sql(self):
+        """
+        SQL for a FROM item of the current output row's neighbours, with the
+        columns distance, rank (1 for the nearest) and the input data columns.
+        """
+        if self.raw_data_layout == 'arrays':
+            return "unnest({arrays}) WITH ORDINALITY AS neighbour (distance, {cols}, rank)".format(
+                arrays=", ".join("{0}.{1}".format(self.output_table, name) for (name, type) in self.raw_data_columns()),
+                cols=", ".join(self.input_data_cols))
+        elif self.raw_data_layout == 'text':
+            # Not sorted, so rank them (ties in the order they're stored, like rows_from_raw_data)
+            cols = "".join(", split_part(raw.value, {sep!r}, {i}) AS {col}".format(sep=self.internal_string_sep, i=i + 2, col=col) for i, col in enumerate(self.input_data_cols))
+            query = """(SELECT split_part(raw.value, {sep!r}, 1)::float AS distance{cols},
+                    row_number() OVER (ORDER BY split_part(raw.value, {sep!r}, 1)::float, raw.i) AS rank
+                FROM unnest({output_table}.{check_col}) WITH ORDINALITY AS raw (value, i)) AS neighbour"""
+            return query.format(sep=self.internal_string_sep, cols=cols, output_table=self.output_table, check_col=self.raw_data_check_col())
+        else:
+            raise ValueError("Unknown raw data layout " + self.raw_data_layout)
+
+    def sql_statistic_sql(self, spec):
+        """
+        SQL expression for one statistic of the current output row, from a spec
+        dict. 'kind' is one of:
+
+            closest        the 'col' of the nearest neighbour ('distance' for it's distance)
+            kth_distance   the distance to the 'k'th nearest
+            most_common    the most common 'col' (ties go to the nearest). With
+                           'within_most_common': OTHER_COL, only of the neighbours
+                           with the most common OTHER_COL, e.g. denomination of the
+                           most common religion
+            count          the number of neighbours (with 'col' = 'value', if given)
+            idw_score      the sum of 1/distance of the neighbours with 'col' = 'value'
+            weighted       the 'col' with the 'lowest' (or 'highest') sum of 1/distance
+            constant       always 'value'
+
+        Optional 'k' and 'radius' (metres) only look at the nearest k
+        neighbours and/or those within radius.
+        """
+        kind = spec['kind']
+        neighbours = self.neighbours_sql()
+        window = "TRUE"
+        if spec.get('k') is not None and kind != 'kth_distance':
+            window += " AND rank <= {0}".format(int(spec['k']))
+        if spec.get('radius') is not None:
+            window += " AND distance <= {0!r}".format(float(spec['radius']))
+        if spec.get('value') is not None and kind in ('count', 'idw_score'):
+            window += " AND {0} = {1}".format(spec['col'], psycopg2.extensions.adapt(spec['value']).getquoted())
+
+        if kind == 'constant':
+            return psycopg2.extensions.adapt(spec['value']).getquoted()
+        elif kind == 'closest':
+            return "(SELECT {col} FROM {neighbours} ORDER BY rank LIMIT 1)".format(col=spec['col'], neighbours=neighbours)
+        elif kind == 'kth_distance':
+            return "(SELECT distance FROM {neighbours} WHERE rank = {k})".format(k=int(spec['k']), neighbours=neighbours)
+        elif kind == 'count':
+            return "(SELECT count(*) FROM {neighbours} WHERE {window})".format(window=window, neighbours=neighbours)
+        elif kind == 'most_common':
+            if spec.get('within_most_common'):
+                other = dict(spec, col=spec['within_most_common'], within_most_common=None)
+                window += " AND {0} = {1}".format(spec['within_most_common'], self.sql_statistic_sql(other))
+            return "(SELECT {col} FROM {neighbours} WHERE {window} GROUP BY {col} ORDER BY count(*) DESC, min(rank) LIMIT 1)".format(col=spec['col'], window=window, neighbours=neighbours)
+        elif kind == 'idw_score':
+            return "(SELECT sum(1 / NULLIF(distance, 0)) FROM {neighbours} WHERE {window})".format(window=window, neighbours=neighbours)
+        elif kind == 'weighted':
+            order = {'lowest': 'ASC', 'highest': 'DESC'}[spec.get('order', 'highest')]
+            return "(SELECT {col} FROM {neighbours} WHERE {window} GROUP BY {col} ORDER BY sum(1 / NULLIF(distance, 0)) {order}, min(rank) LIMIT 1)".format(col=spec['col'], window=window, neighbours=neighbours, order=order)
+        else:
+            raise ValueError("Unknown statistic kind " + kind)
+
+    def calculate_sql_statistics(self):
+        """
+        Calculate the sql_statistics of the rows which need their properties
+        calculated, with one UPDATE per batch of ids, each committed on it's
+        own. Like properties(), cells with no neighbours get the default
+        values, and so do empty windows (except for idw_score & kth_distance,
+        which are NULL).
+        """
+        conn = self.database_connection()
+        db_cursor = conn.cursor()
+        possible_columns = self.properties([])
+        columns = sorted(self.sql_statistics.keys())
+        check_col = self.raw_data_check_col()
+        has_neighbours = "COALESCE(array_length({output_table}.{check_col}, 1), 0) > 0".format(output_table=self.output_table, check_col=check_col)
+
+        expressions = []
+        for column in columns:
+            spec = self.sql_statistics[column]
+            expression = self.sql_statistic_sql(spec)
+            default = psycopg2.extensions.adapt(possible_columns[column]).getquoted()
+            if spec['kind'] not in ('idw_score', 'kth_distance'):
+                expression = "COALESCE({0}, {1})".format(expression, default)
+            expressions.append("CASE WHEN {has_neighbours} THEN {expression} ELSE {default} END::{type} AS {column}".format(
+                has_neighbours=has_neighbours, expression=expression, default=default, column=column,
+                type=self.property_column_type(possible_columns[column])))
+
+        # If python doesn't have to do any, they're finished
+        done = ", properties_calculated = TRUE" if len(self.python_property_columns()) == 0 else ""
+        query = """UPDATE {output_table} SET {sets}{done}
+            FROM (
+                SELECT {output_table}.id, {expressions} FROM {output_table}
+                WHERE {output_table}.properties_calculated IS FALSE AND {output_table}.{check_col} IS NOT NULL AND ({cell_scope})
+                    AND {output_table}.id >= %s AND {output_table}.id < %s
+            ) AS statistics
+            WHERE {output_table}.id = statistics.id;""".format(
+                output_table=self.output_table, check_col=check_col, cell_scope=self.cell_scope, done=done,
+                sets=", ".join("{0} = statistics.{0}".format(k) for k in columns), expressions=", ".join(expressions))
+
+        db_cursor.execute("SELECT min(id), max(id) FROM {output_table} WHERE properties_calculated IS FALSE AND {check_col} IS NOT NULL AND ({cell_scope});".format(
+            output_table=self.output_table, check_col=check_col, cell_scope=self.cell_scope))
+        min_id, max_id = db_cursor.fetchall()[0]
+        conn.commit()
+        if min_id is None:
+            return
+
+        chunks = [(start, min(start + self.properties_batch_size, max_id + 1)) for start in xrange(min_id, max_id + 1, self.properties_batch_size)]
+        started = time.time()
+        for i, chunk in enumerate(chunks):
+            db_cursor.execute(query, chunk)
+            self.instrumentation.add_cells(db_cursor.rowcount)
+            conn.commit()
+            print "Calculating SQL statistics " + progress_message(i + 1, len(chunks), started)
+            self.instrumentation.progress(i + 1, len(chunks), started)
+        db_cursor.close()
+
+    def build_voronoi(self):
+        """
+        Make (or reuse) OUTPUT_TABLE__voronoi, the Voronoi diagram of the input
+        points: one polygon per input point, of the area nearer to it than
+        any other, with that point & it's input data columns. Nearest here
+        is in the srid's units (like <->), not on the sphere, so it's only a
+        starting point for calculate_nearest_site. Only the input points in
+        nearest_site_area_sql are used.
+        It's remade if the input table has changed (it's fingerprint is
+        stored in the table COMMENT).
+        """
+        conn = self.database_connection()
+        db_cursor = conn.cursor()
+        voronoi_table = self.output_table + "__voronoi"
+        fingerprint = self.table_fingerprint(db_cursor, self.input_data_table) + " {0!r} {1!r} {2!r} {3!r} {4!r}".format(self.minlon, self.minlat, self.maxlon, self.maxlat, self.nearest_site_margin)
+
+        db_cursor.execute("SELECT obj_description(to_regclass(%s), 'pg_class');", [voronoi_table])
+        if db_cursor.fetchall()[0][0] == fingerprint:
+            print "Reusing {0}".format(voronoi_table)
+            db_cursor.close()
+            return
+
+        print "Making the Voronoi diagram of {0}...".format(self.input_data_table)
+        # Each polygon is joined back to the input point in it. Points in the
+        # same place only get one polygon, so only one of them is used.
+        data_cols = "".join(", site.{0}".format(col) for col in self.input_data_cols)
+        query = """DROP TABLE IF EXISTS {voronoi_table};
+            CREATE TABLE {voronoi_table} AS
+                SELECT polygons.geom AS cell, site.{input_geom_col} AS site{data_cols}
+                FROM (
+                    SELECT (ST_Dump(ST_VoronoiPolygons(ST_Collect({input_geom_col}), 0, {area}))).geom AS geom
+                    FROM {input_data_table} WHERE {input_geom_col} && {area}
+                ) AS polygons,
+                LATERAL (
+                    SELECT * FROM {input_data_table}
+                    WHERE {input_data_table}.{input_geom_col} && {area} AND ST_Intersects({input_data_table}.{input_geom_col}, polygons.geom) LIMIT 1
+                ) AS site;
+            CREATE INDEX {voronoi_table}__cell ON {voronoi_table} USING gist (cell);"""
+        db_cursor.execute(query.format(voronoi_table=voronoi_table, input_data_table=self.input_data_table, input_geom_col=self.input_geom_col,
+                                       data_cols=data_cols, area=self.nearest_site_area_sql()))
+        db_cursor.execute("COMMENT ON TABLE {0} IS %s;".format(voronoi_table), [fingerprint])
+        db_cursor.execute("ANALYZE {0};".format(voronoi_table))
+        conn.commit()
+        db_cursor.close()
+        print "done."
+
+    def nearest_site_area_sql(self):
+        """SQL for the area whose input points are in the Voronoi diagram, i.e. the area plus nearest_site_margin on each side"""
+        return "ST_MakeEnvelope({0!r}, {1!r}, {2!r}, {3!r}, {4})".format(
+            self.minlon - self.nearest_site_margin, self.minlat - self.nearest_site_margin,
+            self.maxlon + self.nearest_site_margin, self.maxlat + self.nearest_site_margin, self.srid)
+
+    def nearest_site_sets_sql(self, source):
+        """SQL for the SET clause of the properties, from the site & data columns in the source table/subquery"""
+        sets = []
+        for column in sorted(self.sql_statistics):
+            spec = self.sql_statistics[column]
+            if spec['kind'] == 'constant':
+                value = psycopg2.extensions.adapt(spec['value']).getquoted()
+            elif spec['col'] == 'distance':
+                value = "ST_Distance_Sphere({0}.site, {1})".format(source, self.output_geom_as_point_sql())
+            else:
+                value = "{0}.{1}".format(source, spec['col'])
+            sets.append("{0} = {1}".format(column, value))
+        return ", ".join(sets)
+
+    def nearest_site_update_sql(self, bounds):
+        """
+        SQL to set the properties of the cells in bounds (SQL for a subquery
+        of id, point, & bound, the distance in metres to some input point)
+        from the input point nearest on the sphere, like the rest of the
+        statistics. Any point nearer than bound on the sphere is within
+        bound in degrees (at the latitude nearest the pole), so only those
+        are looked at.
+        """
+        data_cols = "".join(", site.{0}".format(col) for col in self.input_data_cols)
+        query = """UPDATE {output_table} SET properties_calculated = TRUE, {sets}
+            FROM (
+                SELECT bounds.id, site.{input_geom_col} AS site{data_cols}
+                FROM ({bounds}) AS bounds, LATERAL (
+                    SELECT * FROM {input_data_table}
+                    WHERE {input_data_table}.{input_geom_col} && ST_Expand(bounds.point, {degrees})
+                    ORDER BY ST_Distance_Sphere({input_data_table}.{input_geom_col}, bounds.point) LIMIT 1
+                ) AS site
+            ) AS nearest
+            WHERE {output_table}.id = nearest.id;"""
+        return query.format(output_table=self.output_table, input_data_table=self.input_data_table, input_geom_col=self.input_geom_col,
+                            data_cols=data_cols, sets=self.nearest_site_sets_sql("nearest"), bounds=bounds,
+                            degrees=self.metres_to_degrees_sql("bounds.bound", "bounds.point"))
+
+    def calculate_nearest_site(self):
+        """
+        Set the properties (all 'closest' sql_statistics) of each cell from
+        it's nearest input point, in chunks of ids, each committed on it's
+        own. No nearest neighbours are needed.
+
+        The site of the Voronoi polygon that the cell's centre is in is the
+        nearest in degrees, not on the sphere, so it's only used to limit
+        the search (see nearest_site_update_sql). Cells not in any polygon
+        (e.g. with input points far outside the area) use their nearest
+        point by <-> instead.
+        """
+        conn = self.database_connection()
+        db_cursor = conn.cursor()
+        voronoi_table = self.output_table + "__voronoi"
+        output_geom_as_point = self.output_geom_as_point_sql()
+
+        # (a centre on the edge of 2 polygons is only done once)
+        bounds = """SELECT DISTINCT ON ({output_table}.id) {output_table}.id, {output_geom_as_point} AS point, ST_Distance_Sphere({voronoi_table}.site, {output_geom_as_point}) AS bound
+            FROM {output_table}, {voronoi_table}
+            WHERE {output_table}.properties_calculated IS FALSE AND ({cell_scope})
+                AND {output_table}.id >= %s AND {output_table}.id < %s
+                AND ST_Intersects({voronoi_table}.cell, {output_geom_as_point})"""
+        query = self.nearest_site_update_sql(bounds.format(output_table=self.output_table, voronoi_table=voronoi_table,
+                                                           cell_scope=self.cell_scope, output_geom_as_point=output_geom_as_point))
+
+        if self.recalculate_properties:
+            db_cursor.execute("UPDATE {output_table} SET properties_calculated = FALSE WHERE properties_calculated IS TRUE;".format(output_table=self.output_table))
+
+        db_cursor.execute("SELECT min(id), max(id) FROM {output_table} WHERE properties_calculated IS FALSE;".format(output_table=self.output_table))
+        min_id, max_id = db_cursor.fetchall()[0]
+        conn.commit()
+        if min_id is None:
+            print "All rows already have their properties"
+            return
+
+        chunks = [(start, min(start + self.properties_batch_size, max_id + 1)) for start in xrange(min_id, max_id + 1, self.properties_batch_size)]
+        started = time.time()
+        for i, chunk in enumerate(chunks):
+            db_cursor.execute(query, chunk)
+            self.instrumentation.add_cells(db_cursor.rowcount)
+            conn.commit()
+            print "Looking up nearest sites " + progress_message(i + 1, len(chunks), started)
+            self.instrumentation.progress(i + 1, len(chunks), started)
+
+        bounds = """SELECT {output_table}.id, {output_geom_as_point} AS point, ST_Distance_Sphere(knn.{input_geom_col}, {output_geom_as_point}) AS bound
+            FROM {output_table}, LATERAL (
+                SELECT {input_geom_col} FROM {input_data_table} ORDER BY {input_data_table}.{input_geom_col} <-> {output_geom_as_point} LIMIT 1
+            ) AS knn
+            WHERE {output_table}.properties_calculated IS FALSE AND ({cell_scope})"""
+        db_cursor.execute(self.nearest_site_update_sql(bounds.format(output_table=self.output_table, input_data_table=self.input_data_table,
+                                                                     input_geom_col=self.input_geom_col, output_geom_as_point=output_geom_as_point,
+                                                                     cell_scope=self.cell_scope)))
+        self.instrumentation.add_cells(db_cursor.rowcount)
+        conn.commit()
+        if db_cursor.rowcount > 0:
+            print "{0} cells weren't covered by the Voronoi diagram, and were looked up directly (a bigger --nearest-site-margin would avoid that)".format(db_cursor.rowcount)
+
+        db_cursor.execute("SELECT count(*) FROM {output_table} WHERE properties_calculated IS FALSE AND ({cell_scope});".format(output_table=self.output_table, cell_scope=self.cell_scope))
+        unmatched = db_cursor.fetchall()[0][0]
+        conn.commit()
+        if unmatched > 0:
+            print "WARNING: {0} cells have no nearest site (is {1} empty?), their properties aren't set".format(unmatched, self.input_data_table)
+        db_cursor.close()
+
+    def final_geom_sql(self):
+        """SQL expression for the geometry of each row as it'll be in the end, i.e. after convert_to_polygons"""
+        if self.output_geom_type == 'polygon':
+            return "{output_table}.{output_geom_col}".format(output_table=self.output_table, output_geom_col=self.output_geom_col)
+        elif self.output_geom_type == 'point':
+            # Works if it's been converted already or not
+            return "ST_Multi(ST_Expand(ST_Centroid(ST_Box2d({output_table}.{output_geom_col})), {half_increment!r}))".format(
+                output_table=self.output_table, output_geom_col=self.output_geom_col, half_increment=self.increment / 2)
+        else:
+            raise TypeError
+
+    def open_output_sink(self, db_cursor):
+        """
+        Open the --output-sink. If some cells already have their properties,
+        we're resuming, and they're in the sink from last time, so it's added
+        to rather than overwritten.
+        """
+        from sinks import open_sink
+        query = "SELECT 1 FROM {output_table} WHERE properties_calculated IS TRUE AND ({cell_scope}) LIMIT 1;"
+        db_cursor.execute(query.format(output_table=self.output_table, cell_scope=self.cell_scope))
+        append = len(db_cursor.fetchall()) > 0
+        if append:
+            print "Adding to the existing {0}".format(self.output_sink)
+        return open_sink(self.output_sink, self, append=append)
+
+    def save_properties(self, writing_cursor, sink, results):
+        """Save a batch of (id, properties) to the output table and/or the sink (if not None)"""
+        if self.sink_only:
+            writing_cursor.execute("UPDATE {output_table} SET properties_calculated = TRUE WHERE id = ANY(%s);".format(output_table=self.output_table), [[id for (id, properties) in results]])
+        elif self.use_copy:
+            self.copy_properties(writing_cursor, results)
+        else:
+            self.update_properties(writing_cursor, results)
+        if sink is not None:
+            self.write_to_sink(writing_cursor, sink, results)
+
+    def write_to_sink(self, db_cursor, sink, results):
+        """Write a batch of (id, properties) to the sink, looking up their geometries"""
+        properties_by_id = dict(results)
+        query = "SELECT id, ST_AsGeoJSON({geom}) FROM {output_table} WHERE id = ANY(%s);".format(geom=self.final_geom_sql(), output_table=self.output_table)
+        db_cursor.execute(query, [properties_by_id.keys()])
+        for id, geometry in db_cursor.fetchall():
+            sink.write(json.loads(geometry), properties_by_id[id])
+
+    def compute_properties(self, records):
+        """
+        Given a list of (id, raw_data), return a list of (id, properties).
+        raw_data is a tuple of the values of the raw_data_columns().
+        This might be called in another process.
+        """
+        ids = [id for (id, raw_data) in records]
+        return zip(ids, self.properties_many([self.rows_from_raw_data(raw_data) for (id, raw_data) in records]))
+
+    def properties_many(self, rows_list):
+        """
+        Calculate properties() for a list of cells at once. This just calls
+        properties() for each, but subclasses can override it to do them all
+        together, e.g. with numpy.
+        """
+        return [self.properties(rows) for rows in rows_list]
+
+    def rows_from_raw_data(self, raw_data):
+        """
+        Convert the raw_data from the database into the list of rows that
+        properties() takes, sorted by distance.
+        """
+        if self.raw_data_layout == 'arrays':
+            # Already typed, and sorted by distance, so just zip them together
+            distances, data_cols = raw_data[0], raw_data[1:]
+            return [[distance] + self.clean_row_data(list(row)) for (distance, row) in zip(distances, zip(*data_cols))]
+
+        raw_data = raw_data[0]
+
+        # Raw data is an array of TEXT, each element is the distance to a point, and then the input data columns
+        # e.g. { '12|christian|catholic', '23|christian|', … }
+        # So split it into a 2d list of list. Would like to have a native postgres 2d array (e.g.g text[][]), but it couldn't work with the aggregates.
+        raw_data = [x.split(self.internal_string_sep, 1+len(self.input_data_cols)) for x in raw_data]
+
+        # floatify the distance (first element)
+        raw_data = [[float(item[0])] + self.clean_row_data(item[1:]) for item in raw_data]
+
+        # raw data not guarantted to be sorted by distance ascending, so do it here
+        raw_data.sort(key=lambda r:r[0])
+
+        return raw_data
+
+    def rows_needing_properties_sql(self, where="TRUE"):
+        """SQL to select the id & raw data columns of rows which need their properties calculated, and match the where SQL fragment"""
+        providers = self.raw_data_providers()
+        query = "SELECT id, {raw_columns} FROM {output_table} WHERE properties_calculated IS FALSE AND {has_raw_data} AND ({cell_scope}) AND ({where}) ORDER BY id"
+        return query.format(
+            output_table=self.output_table, cell_scope=self.cell_scope, where=where,
+            has_raw_data=" AND ".join("{0} IS NOT NULL".format(provider.raw_data_check_col()) for provider in providers),
+            raw_columns=", ".join(name for provider in providers for (name, type) in provider.raw_data_columns()))
+
+    def rows_needing_properties(self, conn):
+        """
+        Yield (id, raw_data) for every row which needs it's properties
+        calculated. Rows are read in pages by id, rather than with one server
+        side cursor, so that it's OK to commit while iterating.
+        """
+        reading_cursor = conn.cursor()
+        query = self.rows_needing_properties_sql("id > %s") + " LIMIT %s;"
+        last_id = -1
+        while True:
+            reading_cursor.execute(query, [last_id, self.properties_batch_size])
+            rows = reading_cursor.fetchall()
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield (row[0], row[1:])
+            last_id = rows[-1][0]
+        reading_cursor.close()
+
+    def update_properties(self, writing_cursor, results):
+        """
+        Save the properties for many rows at once, with one UPDATE ... FROM
+        (VALUES ...). results is a list of (id, properties) tuples.
+        """
+        possible_columns = self.properties([])
+        columns = self.python_property_columns()
+
+        # Cast everything, so postgres knows the types of the VALUES
+        row_template = "(%s::integer, " + ", ".join("%s::" + self.property_column_type(possible_columns[k]) for k in columns) + ")"
+        values = ", ".join(writing_cursor.mogrify(row_template, [id] + [properties.get(k) for k in columns]) for (id, properties) in results)
+
+        query = "UPDATE {output_table} SET properties_calculated = TRUE, {sets} FROM (VALUES {values}) AS new_values (id, {columns}) WHERE {output_table}.id = new_values.id;".format(
+            output_table=self.output_table, values=values, columns=", ".join(columns),
+            sets=", ".join("{0} = new_values.{0}".format(k) for k in columns))
+        writing_cursor.execute(query)
+
+    def copy_properties(self, writing_cursor, results):
+        """
+        Save the properties for many rows at once. results is a list of (id,
+        properties) tuples. They are COPY'ed into a temporary staging table,
+        and the output table is updated from that with one join.
+        """
+        staging_table = self.output_table + "__properties_staging"
+        possible_columns = self.properties([])
+        columns = self.python_property_columns()
+
+        column_defs = ", ".join("{0} {1}".format(k, self.property_column_type(possible_columns[k])) for k in columns)
+        writing_cursor.execute("CREATE TEMPORARY TABLE IF NOT EXISTS {0} (id integer, {1});".format(staging_table, column_defs))
+        writing_cursor.execute("TRUNCATE {0};".format(staging_table))
+
+        copy_rows(writing_cursor, staging_table, ['id'] + columns, ([id] + [properties.get(k) for k in columns] for (id, properties) in results))
+
+        query = "UPDATE {output_table} SET properties_calculated = TRUE, {sets} FROM {staging_table} WHERE {output_table}.id = {staging_table}.id;".format(
+            output_table=self.output_table, staging_table=staging_table,
+            sets=", ".join("{0} = {1}.{0}".format(k, staging_table) for k in columns))
+        writing_cursor.execute(query)
+
     def clean_row_data(self, row):
         """Python data cleaning/sanitization. This does nothing, but subclasses might want to override it"""
         return row
@@ -433,22 +2015,124 @@ class OSMStatsAggregator(object):
             raise ValueError
         
         
+    def build_pyramid(self):
+        """
+        Make coarser versions of the output table, where each cell is made from
+        the 2x2, 4x4, 8x8... cells of the output table in it. Rather than
+        recalculating everything, the properties of the child cells are
+        combined: the average for numbers, and the most common value for text.
+        Each level is in it's own table, with a level column.
+        """
+        conn = self.database_connection()
+        db_cursor = conn.cursor()
+
+        possible_columns = self.properties([])
+        aggregates = []
+        for column in sorted(possible_columns):
+            if self.property_column_type(possible_columns[column]) == "REAL":
+                aggregates.append("avg({0})::real AS {0}".format(column))
+            else:
+                aggregates.append("mode() WITHIN GROUP (ORDER BY {0}) AS {0}".format(column))
+
+        db_cursor.execute("ALTER TABLE {0} ADD COLUMN IF NOT EXISTS level integer DEFAULT 0;".format(self.output_table))
+
+        for level in range(1, self.pyramid_levels + 1):
+            level_table = "{0}_level{1}".format(self.output_table, level)
+            size = self.increment * (2 ** level)
+
+            if self.output_geom_type == 'polygon' and self.cut_land_boxes:
+                # keep the coastline
+                geom = "ST_Multi(ST_Union({0}))".format(self.output_geom_col)
+            else:
+                geom = "ST_Multi(ST_MakeEnvelope({minlon} + x * {size}, {minlat} + y * {size}, {minlon} + (x + 1) * {size}, {minlat} + (y + 1) * {size}, {srid}))".format(
+                    minlon=repr(float(self.minlon)), minlat=repr(float(self.minlat)), size=repr(size), srid=self.srid)
+
+            query = """CREATE TABLE {level_table} AS
+                SELECT (row_number() OVER ())::integer AS id, {level} AS level, {aggregates},
+                    {geom}::geometry(MultiPolygon, {srid}) AS {output_geom_col}
+                FROM (
+                    SELECT *,
+                        floor((ST_X(ST_Centroid(ST_Box2d({output_geom_col}))) - {minlon}) / {size})::integer AS x,
+                        floor((ST_Y(ST_Centroid(ST_Box2d({output_geom_col}))) - {minlat}) / {size})::integer AS y
+                    FROM {output_table} WHERE properties_calculated IS TRUE
+                ) AS children
+                GROUP BY x, y;"""
+            query = query.format(level_table=level_table, level=level, aggregates=", ".join(aggregates),
+                                 geom=geom, srid=self.srid, output_geom_col=self.output_geom_col,
+                                 minlon=repr(float(self.minlon)), minlat=repr(float(self.minlat)),
+                                 size=repr(size), output_table=self.output_table)
+
+            print "Making pyramid level {0} ({1})".format(level, level_table)
+            db_cursor.execute("DROP TABLE IF EXISTS {0};".format(level_table))
+            db_cursor.execute(query)
+            db_cursor.execute("ALTER TABLE {0} ADD PRIMARY KEY (id);".format(level_table))
+            db_cursor.execute("create index {0}__{1} on {0} using gist ({1});".format(level_table, self.output_geom_col))
+            conn.commit()
+
+        db_cursor.close()
+
     def main(self):
+        self.parse_args()
+
+        if self.backend == 'memory':
+            # Only imported here, so numpy etc. aren't needed for the database backend
+            from memory import MemoryBackend
+            MemoryBackend(self).run()
+            return
+
         try:
+            if self.coordinator or self.worker:
+                from tiles import TileQueue
+                TileQueue(self).run()
+                return
 
-            self.parse_args()
+            with self.instrumentation.phase('create_table'):
+                self.create_table()
 
-            self.create_table()
-            
-            self.create_land_boxes()
+            with self.instrumentation.phase('prepare_land'):
+                self.prepare_land()
+
+            if self.pipeline:
+                from pipeline import Pipeline
+                with self.instrumentation.phase('pipeline'):
+                    Pipeline(self).run()
+
+            elif self.nearest_site:
+                with self.instrumentation.phase('create_land_boxes'):
+                    self.create_land_boxes()
+
+                with self.instrumentation.phase('build_voronoi'):
+                    self.build_voronoi()
+
+                with self.instrumentation.phase('nearest_site'):
+                    self.calculate_nearest_site()
+
+            else:
+                with self.instrumentation.phase('create_land_boxes'):
+                    self.create_land_boxes()
+
+                if self.changes_table or self.changes_file:
+                    with self.instrumentation.phase('mark_changed_cells'):
+                        self.mark_changed_cells()
+
+                with self.instrumentation.phase('populate_raw_data'):
+                    self.populate_raw_data()
+
+                with self.instrumentation.phase('calculate_properties'):
+                    self.calculate_properties()
 
-            self.populate_raw_data()
+            if not self.sink_only:
+                with self.instrumentation.phase('convert_to_polygons'):
+                    self.convert_to_polygons()
 
-            self.calculate_properties()
+                if self.pyramid_levels > 0:
+                    with self.instrumentation.phase('build_pyramid'):
+                        self.build_pyramid()
 
-            self.convert_to_polygons()
+            self.instrumentation.print_summary()
 
         finally:
             # Commit anything unsaved yet
             self.database_connection().commit()
+            self.instrumentation.close()
         return
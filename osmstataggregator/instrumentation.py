@@ -0,0 +1,132 @@
+# encoding: utf-8
+"""
+Timing & progress for each phase of a run.
+
+Every phase records it's wall time, how many cells it processed, and how much
+of the time was spent waiting on the database (and how many queries). Progress
+and the end of each phase are emitted as JSON objects, one per line, to a file
+and/or a callback, so runs can be monitored and compared by other programs.
+"""
+from __future__ import division
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2.extensions
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """A cursor which tells the connection's instrumentation how long each query took"""
+
+    def execute(self, query, vars=None):
+        started = time.time()
+        try:
+            return super(InstrumentedCursor, self).execute(query, vars)
+        finally:
+            self.connection.instrumentation.record_query(time.time() - started)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.time()
+        try:
+            return super(InstrumentedCursor, self).copy_expert(sql, file, size)
+        finally:
+            self.connection.instrumentation.record_query(time.time() - started)
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """A connection whose cursors are InstrumentedCursors"""
+    instrumentation = None
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault('cursor_factory', InstrumentedCursor)
+        return super(InstrumentedConnection, self).cursor(*args, **kwargs)
+
+
+class Instrumentation(object):
+
+    # Don't emit progress events more often than this (in seconds)
+    progress_interval = 1
+
+    def __init__(self, progress_file=None, callback=None):
+        self.progress_fp = open(progress_file, 'a') if progress_file else None
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.phases = []
+        self.current = None
+        self.last_progress = 0
+
+    def emit(self, event, **data):
+        data['event'] = event
+        data['time'] = time.time()
+        if self.current is not None:
+            data.setdefault('phase', self.current['phase'])
+        if self.progress_fp is not None:
+            self.progress_fp.write(json.dumps(data) + "\n")
+            self.progress_fp.flush()
+        if self.callback is not None:
+            self.callback(data)
+
+    @contextmanager
+    def phase(self, name):
+        self.current = {'phase': name, 'started': time.time(), 'cells': 0, 'queries': 0, 'db_seconds': 0.0}
+        self.emit('phase_start')
+        try:
+            yield
+        finally:
+            phase = self.current
+            phase['seconds'] = time.time() - phase.pop('started')
+            # With several worker connections, the database time can be more than the wall time
+            phase['python_seconds'] = max(phase['seconds'] - phase['db_seconds'], 0)
+            phase['cells_per_second'] = (phase['cells'] / phase['seconds']) if phase['seconds'] > 0 else None
+            self.phases.append(phase)
+            self.emit('phase_end', **phase)
+            self.current = None
+
+    def record_query(self, seconds):
+        with self.lock:
+            if self.current is not None:
+                self.current['queries'] += 1
+                self.current['db_seconds'] += seconds
+
+    def add_cells(self, cells):
+        with self.lock:
+            if self.current is not None:
+                self.current['cells'] += cells
+
+    def progress(self, done, total, started):
+        """Emit a progress event (with an ETA), unless we've just done that"""
+        now = time.time()
+        with self.lock:
+            if done < total and now - self.last_progress < self.progress_interval:
+                return
+            self.last_progress = now
+        elapsed = now - started
+        rate = (done / elapsed) if elapsed > 0 else None
+        eta = ((total - done) / rate) if rate else None
+        self.emit('progress', done=done, total=total, elapsed=elapsed, per_second=rate, eta_seconds=eta)
+
+    def explain(self, cursor, name, query, vars=None):
+        """
+        Run EXPLAIN (ANALYZE, BUFFERS) on this query, and emit the plan. It's
+        run in a savepoint which is rolled back, so it doesn't change anything.
+        """
+        cursor.execute("SAVEPOINT explain;")
+        try:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, vars)
+            plan = cursor.fetchall()[0][0]
+        finally:
+            cursor.execute("ROLLBACK TO SAVEPOINT explain;")
+        self.emit('explain', name=name, plan=plan)
+
+    def print_summary(self):
+        print "\n{0:>22} {1:>9} {2:>9} {3:>9} {4:>8} {5:>10}".format("phase", "seconds", "db", "python", "queries", "cells/s")
+        for phase in self.phases:
+            print "{phase:>22} {seconds:9.1f} {db_seconds:9.1f} {python_seconds:9.1f} {queries:8d} {rate:>10}".format(
+                rate=int(phase['cells_per_second']) if phase['cells_per_second'] else "", **phase)
+
+    def close(self):
+        if self.progress_fp is not None:
+            self.progress_fp.close()
+            self.progress_fp = None
@@ -0,0 +1,165 @@
+# encoding: utf-8
+"""
+Run an OSMStatsAggregator without a database.
+
+The input points are loaded from a CSV or GeoJSON file, and the land polygons
+from a GeoJSON file. The nearest input points to each cell are found with a
+KD-tree of the points on the unit sphere (so distances are great circle
+distances), and the results are written to a file sink (newline delimited
+GeoJSON unless the filename says otherwise).
+
+This needs numpy, scipy and shapely, which the database backend doesn't.
+"""
+from __future__ import division
+
+import csv
+import json
+
+import numpy
+from scipy.spatial import cKDTree
+from shapely.geometry import MultiPolygon, Point, box, mapping, shape
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+from common import batch
+from sinks import open_sink
+
+# The same sphere that ST_Distance_Sphere uses
+EARTH_RADIUS = 6370986.0
+
+
+def to_unit_sphere(lons, lats):
+    """Convert arrays of lon/lat (in degrees) into an (N, 3) array of points on the unit sphere"""
+    lons, lats = numpy.radians(lons), numpy.radians(lats)
+    return numpy.column_stack([
+        numpy.cos(lats) * numpy.cos(lons),
+        numpy.cos(lats) * numpy.sin(lons),
+        numpy.sin(lats),
+    ])
+
+def chord_to_metres(chord):
+    """Convert the straight line distance between 2 points on the unit sphere, to the great circle distance in metres"""
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.minimum(chord / 2, 1.0))
+
+def polygonal_part(geom):
+    """
+    Only the polygons in geom (the intersection of the land & a cell can also
+    have points & lines, where they just touch), like ST_CollectionExtract(..., 3).
+    Returns None if there are none.
+    """
+    if geom.geom_type in ('Polygon', 'MultiPolygon'):
+        return None if geom.is_empty else geom
+    polygons = []
+    for part in getattr(geom, 'geoms', []):
+        if part.geom_type == 'Polygon':
+            polygons.append(part)
+        elif part.geom_type == 'MultiPolygon':
+            polygons.extend(part.geoms)
+    polygons = [p for p in polygons if not p.is_empty]
+    return MultiPolygon(polygons) if len(polygons) > 0 else None
+
+def load_points(filename, input_data_cols):
+    """
+    Load the input points from a CSV file (with 'lon' & 'lat' columns) or a
+    GeoJSON file of Point features. Returns (lons, lats, data) where data is a
+    list of the values of input_data_cols for each point.
+    """
+    lons, lats, data = [], [], []
+    if filename.endswith(".csv"):
+        with open(filename) as fp:
+            for row in csv.DictReader(fp):
+                lons.append(float(row['lon']))
+                lats.append(float(row['lat']))
+                data.append([row.get(col) or '' for col in input_data_cols])
+    else:
+        with open(filename) as fp:
+            features = json.load(fp)['features']
+        for feature in features:
+            lon, lat = feature['geometry']['coordinates'][:2]
+            lons.append(lon)
+            lats.append(lat)
+            # Like CONCAT in the database, missing values become ''
+            data.append([feature['properties'].get(col) or '' for col in input_data_cols])
+
+    return numpy.array(lons), numpy.array(lats), data
+
+def load_land(filename):
+    """Load the land polygons from a GeoJSON file, as one shapely geometry"""
+    with open(filename) as fp:
+        features = json.load(fp)['features']
+    return unary_union([shape(feature['geometry']) for feature in features])
+
+
+class MemoryBackend(object):
+    """Does the work of create_land_boxes, populate_raw_data & calculate_properties, in memory"""
+
+    # How many cells to look up in the KD-tree at once
+    cells_per_batch = 10000
+
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+
+    def land_cells(self):
+        """
+        Yield (geometry, centre_lon, centre_lat) for each cell on land. The
+        geometry is what the final output geometry would be.
+        """
+        agg = self.aggregator
+        land = load_land(agg.land_file)
+        prepared_land = prep(land)
+
+        for bbox in agg.generate_boxes():
+            cell = box(bbox['minlon'], bbox['minlat'], bbox['maxlon'], bbox['maxlat'])
+            if agg.output_geom_type == 'point':
+                if not prepared_land.contains(Point(bbox['centre_lon'], bbox['centre_lat'])):
+                    continue
+                geom = cell
+            elif agg.output_geom_type == 'polygon':
+                if not prepared_land.intersects(cell):
+                    continue
+                if agg.cut_land_boxes and not prepared_land.contains(cell):
+                    geom = polygonal_part(land.intersection(cell))
+                    if geom is None:
+                        continue
+                else:
+                    geom = cell
+            else:
+                raise TypeError
+
+            yield geom, bbox['centre_lon'], bbox['centre_lat']
+
+    def run(self):
+        agg = self.aggregator
+
+        lons, lats, data = load_points(agg.input_file, agg.input_data_cols)
+        print "Loaded {0} input points".format(len(data))
+        k = min(agg.neighbour_limits()[0], len(data))
+        tree = cKDTree(to_unit_sphere(lons, lats)) if k > 0 else None
+
+        output = open_sink(agg.output_file, agg)
+        try:
+            for cells in batch(self.land_cells(), self.cells_per_batch):
+                if k == 0:
+                    # No input points, so every cell gets the default properties
+                    for (geom, lon, lat), properties in zip(cells, agg.properties_many([[] for c in cells])):
+                        output.write(mapping(geom), properties)
+                    continue
+
+                centres = to_unit_sphere([c[1] for c in cells], [c[2] for c in cells])
+                chords, indexes = tree.query(centres, k=k)
+                # with k=1, scipy returns 1d arrays
+                chords, indexes = chords.reshape(len(cells), k), indexes.reshape(len(cells), k)
+                distances = chord_to_metres(chords)
+
+                # Already sorted by distance
+                rows_list = [
+                    [[float(distance)] + agg.clean_row_data(list(data[index])) for distance, index in zip(cell_distances, cell_indexes)]
+                    for cell_distances, cell_indexes in zip(distances, indexes)
+                ]
+
+                for (geom, lon, lat), properties in zip(cells, agg.properties_many(rows_list)):
+                    output.write(mapping(geom), properties)
+        finally:
+            output.close()
+
+        print "Wrote {0}".format(agg.output_file)
@@ -0,0 +1,113 @@
+# encoding: utf-8
+"""
+Run several aggregators against one grid, sharing the expensive parts.
+"""
+from collections import OrderedDict
+
+from common import OSMStatsAggregator
+
+
+class MultiAggregator(OSMStatsAggregator):
+    """
+    Calculates the properties of several aggregators (the providers) in one
+    output table.
+
+    The grid & land cutting is done once, with this class's settings. The
+    nearest neighbours are found once per input table, and stored in raw data
+    columns named after that table (e.g. raw_religion_point_data). Providers
+    that use the same input table share the same neighbours (with the input
+    columns of all of them). Then every provider's properties() is calculated
+    from one pass over the output table.
+
+    e.g.
+
+        class ReligionAndShops(EuropeArea, MultiAggregator):
+            providers = [ReligionMap, ShopMap]
+            output_table = "religion_and_shops"
+            land = 'land_polygons.the_geom'
+            database = "gis"
+    """
+    providers = []
+
+    # These are per input table, everything else is the same for all providers
+    input_settings = ['input_data_table', 'input_geom_col', 'input_data_cols', 'raw_data_prefix']
+
+    def parse_args(self, args=None):
+        super(MultiAggregator, self).parse_args(args)
+        # Which cells are affected depends on each input table
+        assert not (self.changes_table or self.changes_file), "--changes-table/--changes-file aren't supported with several aggregators"
+        assert len(self.providers) > 0
+        # The memory backend reads one input file, with this aggregator's input_data_cols
+        assert self.backend == 'postgis', "Several aggregators need --backend postgis"
+        self.setup_providers()
+
+    def shared_settings(self):
+        return dict((k, v) for (k, v) in self.__dict__.items() if k not in self.input_settings and k not in ('conn', 'provider_instances', 'groups'))
+
+    def setup_providers(self):
+        """Make an instance of each provider, and one 'group' aggregator per input table to find the nearest neighbours with"""
+        groups = OrderedDict()
+        self.provider_instances = []
+        for provider_class in self.providers:
+            provider = provider_class()
+            provider.__dict__.update(self.shared_settings())
+
+            key = (provider.input_data_table, provider.input_geom_col)
+            if key not in groups:
+                group = OSMStatsAggregator()
+                group.__dict__.update(self.shared_settings())
+                group.input_data_table, group.input_geom_col = key
+                group.input_data_cols = []
+                # (a schema qualified table name isn't a valid column name)
+                group.raw_data_prefix = "raw_" + provider.input_data_table.replace(".", "_")
+                groups[key] = group
+
+            group = groups[key]
+            for col in provider.input_data_cols:
+                if col not in group.input_data_cols:
+                    group.input_data_cols.append(col)
+            self.provider_instances.append((provider, group))
+
+        self.groups = groups.values()
+
+    def raw_data_providers(self):
+        return self.groups
+
+    def properties(self, rows):
+        """The (default) properties of all the providers. Only useful with no rows, to find the columns"""
+        results = {}
+        for provider, group in self.provider_instances:
+            results.update(provider.properties(rows))
+        return results
+
+    def populate_raw_data(self):
+        """Find the nearest neighbours once for each input table"""
+        for group in self.groups:
+            print "Nearest neighbours from {0}".format(group.input_data_table)
+            group.conn = self.database_connection()
+            group.cell_scope = self.cell_scope
+            group.populate_raw_data()
+
+    def compute_properties(self, records):
+        """
+        records have the raw data of every group, one after the other. Split
+        them up, and give each provider the rows for it's own input columns.
+        """
+        ids = [id for (id, raw_data) in records]
+        results = [{} for _ in records]
+
+        offset = 0
+        for group in self.groups:
+            width = len(group.raw_data_columns())
+            rows_list = [group.rows_from_raw_data(raw_data[offset:offset + width]) for (id, raw_data) in records]
+            offset += width
+
+            for provider, provider_group in self.provider_instances:
+                if provider_group is not group:
+                    continue
+                indexes = [group.input_data_cols.index(col) for col in provider.input_data_cols]
+                provider_rows_list = [[[row[0]] + provider.clean_row_data([row[1 + i] for i in indexes]) for row in rows] for rows in rows_list]
+                for result, properties in zip(results, provider.properties_many(provider_rows_list)):
+                    result.update(properties)
+
+        return zip(ids, results)
@@ -0,0 +1,221 @@
+# encoding: utf-8
+"""
+Make the land boxes, raw data & properties at the same time.
+
+Normally each phase is done for the whole grid before the next starts, so
+the database is idle while properties are calculated in python, and nothing
+is finished until the end. Here, batches of cells flow through 4 stages,
+each in it's own thread(s) with it's own database connection, joined by
+bounded queues:
+
+    land boxes (one latitude band at a time, INSERT ... RETURNING id)
+      -> nearest neighbours (--workers threads)
+      -> properties (--processes threads, using a process pool if > 1)
+      -> writing the properties (and the --output-sink)
+
+Every stage commits each batch, so the first results appear after the first
+band, and an interrupted run can be resumed (the bands that were inserted are
+recorded, as with --workers). The land cache isn't used here.
+"""
+import multiprocessing
+import Queue
+import threading
+import time
+
+from common import _compute_properties_in_worker, _init_properties_worker
+
+
+class Pipeline(object):
+
+    # How many batches can wait between each stage
+    queue_size = 4
+
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+        self.errors = []
+        self.threads = []
+
+    def start_stage(self, func, in_queue, out_queue, threads=1, next_threads=1):
+        """
+        Start threads which call func(conn, item) on each item from in_queue
+        (until they get a None), and put the result (if any) on out_queue.
+        When they've all finished, next_threads Nones are put on out_queue.
+        """
+        remaining = [threads]
+        lock = threading.Lock()
+
+        def stage():
+            conn = None
+            try:
+                try:
+                    conn = self.aggregator.new_connection()
+                except Exception as e:
+                    # Keep taking items anyway, see below
+                    self.errors.append(e)
+                while True:
+                    item = in_queue.get()
+                    if item is None:
+                        return
+                    if self.errors:
+                        # Keep taking items, so the stage before doesn't block
+                        continue
+                    try:
+                        result = func(conn, item)
+                        if out_queue is not None and result:
+                            out_queue.put(result)
+                    except Exception as e:
+                        conn.rollback()
+                        self.errors.append(e)
+            finally:
+                if conn is not None:
+                    conn.close()
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last and out_queue is not None:
+                    for _ in range(next_threads):
+                        out_queue.put(None)
+
+        for _ in range(threads):
+            thread = threading.Thread(target=stage)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def land_batches(self, conn):
+        """
+        Insert the land boxes one latitude band at a time, yielding a list of
+        the new ids for each. If the output table already has rows, first
+        yield the ids of the ones which aren't finished, then carry on with
+        the bands that weren't done, if the last run was interrupted.
+        """
+        agg = self.aggregator
+        db_cursor = conn.cursor()
+        db_cursor.execute("SELECT 1 FROM {0} LIMIT 1;".format(agg.output_table))
+        has_rows = len(db_cursor.fetchall()) > 0
+        finished = agg.finished_land_bands(db_cursor)
+
+        if has_rows:
+            print "Table {0} already has rows, doing the unfinished ones first".format(agg.output_table)
+            query = "SELECT id FROM {0} WHERE properties_calculated IS FALSE AND id > %s ORDER BY id LIMIT %s;".format(agg.output_table)
+            last_id = -1
+            while True:
+                db_cursor.execute(query, [last_id, agg.raw_data_chunk_size])
+                ids = [row[0] for row in db_cursor.fetchall()]
+                conn.commit()
+                if len(ids) == 0:
+                    break
+                yield ids
+                last_id = ids[-1]
+            if finished is None:
+                # All the land boxes were made
+                return
+            print "Doing the rest of the land boxes, {0} latitude bands were done".format(len(finished))
+        else:
+            agg.finish_land_bands(db_cursor)
+            agg.start_land_bands(db_cursor)
+            conn.commit()
+            finished = set()
+
+        agg.prepare_land_box_statements(db_cursor)
+        for band in agg.remaining_land_bands(finished):
+            ids = []
+            for bbox in band:
+                db_cursor.execute("EXECUTE land_box (%s, %s, %s, %s);", [bbox['minlon'], bbox['minlat'], bbox['maxlon'], bbox['maxlat']])
+                ids.extend(row[0] for row in db_cursor.fetchall())
+            agg.record_land_band(db_cursor, band)
+            conn.commit()
+            if len(ids) > 0:
+                yield ids
+
+        agg.finish_land_bands(db_cursor)
+        conn.commit()
+
+    def populate_raw_data(self, conn, ids):
+        db_cursor = conn.cursor()
+        for provider in self.aggregator.raw_data_providers():
+            db_cursor.execute(provider.raw_data_update_sql("id = ANY(%s)"), [ids])
+        conn.commit()
+        db_cursor.close()
+        return ids
+
+    def compute_properties(self, conn, ids):
+        agg = self.aggregator
+        db_cursor = conn.cursor()
+        db_cursor.execute(agg.rows_needing_properties_sql("id = ANY(%s)") + ";", [ids])
+        records = [(row[0], row[1:]) for row in db_cursor.fetchall()]
+        conn.commit()
+        db_cursor.close()
+        if len(records) == 0:
+            return None
+        if self.pool is not None:
+            return self.pool.apply(_compute_properties_in_worker, (records,))
+        else:
+            return agg.compute_properties(records)
+
+    def save_properties(self, conn, results):
+        agg = self.aggregator
+        db_cursor = conn.cursor()
+        agg.save_properties(db_cursor, self.sink, results)
+        if self.sink is not None:
+            self.sink.flush()
+        conn.commit()
+        db_cursor.close()
+
+        self.done += len(results)
+        agg.instrumentation.add_cells(len(results))
+        elapsed = time.time() - self.started
+        print "Pipeline: {0} cells done in {1:.0f}s ({2:.0f} cells/s)".format(self.done, elapsed, self.done / elapsed if elapsed > 0 else 0)
+
+    def run(self):
+        agg = self.aggregator
+        conn = agg.database_connection()
+
+        if agg.recalculate_properties:
+            db_cursor = conn.cursor()
+            db_cursor.execute("UPDATE {output_table} SET properties_calculated = FALSE WHERE properties_calculated IS TRUE;".format(output_table=agg.output_table))
+            conn.commit()
+            db_cursor.close()
+
+        self.pool = None
+        if agg.processes > 1:
+            self.pool = multiprocessing.Pool(agg.processes, _init_properties_worker, (agg,))
+        self.sink = None
+        if agg.output_sink:
+            db_cursor = conn.cursor()
+            self.sink = agg.open_output_sink(db_cursor)
+            conn.commit()
+            db_cursor.close()
+        self.started, self.done = time.time(), 0
+
+        land_queue = Queue.Queue(maxsize=self.queue_size)
+        raw_data_queue = Queue.Queue(maxsize=self.queue_size)
+        properties_queue = Queue.Queue(maxsize=self.queue_size)
+
+        self.start_stage(self.populate_raw_data, land_queue, raw_data_queue, threads=agg.workers, next_threads=agg.processes)
+        self.start_stage(self.compute_properties, raw_data_queue, properties_queue, threads=agg.processes, next_threads=1)
+        self.start_stage(self.save_properties, properties_queue, None)
+
+        try:
+            # The land boxes are made in this thread
+            for ids in self.land_batches(conn):
+                if self.errors:
+                    break
+                land_queue.put(ids)
+        except Exception as e:
+            conn.rollback()
+            self.errors.append(e)
+        finally:
+            for _ in range(agg.workers):
+                land_queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+            if self.sink is not None:
+                self.sink.close()
+
+        if self.errors:
+            raise self.errors[0]
+        print "Pipeline finished, {0} cells".format(self.done)
@@ -10,6 +10,34 @@ class ReligionMap(OSMStatsAggregator):
     land = 'land_polygons.the_geom'
     database = "gis2"
 
+    # Everything properties() calculates, for --sql-statistics
+    sql_statistics = {
+        'closest_religion': {'kind': 'closest', 'col': 'religion'},
+        'closest_denomination': {'kind': 'closest', 'col': 'denomination'},
+        'closest_pow': {'kind': 'closest', 'col': 'distance'},
+        'closest_3_pow': {'kind': 'kth_distance', 'k': 3},
+        'most_common_religion': {'kind': 'most_common', 'col': 'religion'},
+        'most_common_denomination': {'kind': 'most_common', 'col': 'denomination', 'within_most_common': 'religion'},
+        'most_common_10_religion': {'kind': 'most_common', 'col': 'religion', 'k': 10},
+        'most_common_10_denomination': {'kind': 'most_common', 'col': 'denomination', 'within_most_common': 'religion', 'k': 10},
+        'most_common_religion_wi_50km': {'kind': 'most_common', 'col': 'religion', 'radius': 50000},
+        'most_common_denomination_wi_50km': {'kind': 'most_common', 'col': 'denomination', 'within_most_common': 'religion', 'radius': 50000},
+        'most_common_religion_wi_10km': {'kind': 'most_common', 'col': 'religion', 'radius': 10000},
+        'most_common_denomination_wi_10km': {'kind': 'most_common', 'col': 'denomination', 'within_most_common': 'religion', 'radius': 10000},
+        'most_common_religion_wi_5km': {'kind': 'most_common', 'col': 'religion', 'radius': 5000},
+        'most_common_denomination_wi_5km': {'kind': 'most_common', 'col': 'denomination', 'within_most_common': 'religion', 'radius': 5000},
+        # properties() takes the lowest score, so this does too
+        'weighted_most_common_religion': {'kind': 'weighted', 'col': 'religion', 'order': 'lowest'},
+        # properties() never sets this
+        'weighted_most_common_denomination': {'kind': 'constant', 'value': ''},
+        'christian_score': {'kind': 'idw_score', 'col': 'religion', 'value': 'christian'},
+        'muslim_score': {'kind': 'idw_score', 'col': 'religion', 'value': 'muslim'},
+        'hindu_score': {'kind': 'idw_score', 'col': 'religion', 'value': 'hindu'},
+        'buddhist_score': {'kind': 'idw_score', 'col': 'religion', 'value': 'buddhist'},
+        'shinto_score': {'kind': 'idw_score', 'col': 'religion', 'value': 'shinto'},
+        'jewish_score': {'kind': 'idw_score', 'col': 'religion', 'value': 'jewish'},
+    }
+
     @classmethod
     def _most_common(kls, rows):
         most_common_religion, count = Counter([x[1] for x in rows]).most_common(1)[0]
@@ -88,10 +116,182 @@ class ReligionMap(OSMStatsAggregator):
 
         return results
 
+    def neighbour_requirements(self):
+        return [
+            (1, None),          # closest_*
+            (3, None),          # closest_3_pow
+            (10, None),         # most_common_10_*
+            (None, 50000),      # most_common_*_wi_50km (& 10km & 5km)
+            # most_common_* and the scores use all the neighbours
+            (None, None),
+        ]
+
+    def properties_many(self, rows_list):
+        """
+        With --vectorised, calculate the properties for many cells at once with
+        numpy, otherwise call properties() on each.
+        """
+        if not self.vectorised:
+            return super(ReligionMap, self).properties_many(rows_list)
+
+        results = [None] * len(rows_list)
+        to_vectorise = []
+        for i, rows in enumerate(rows_list):
+            if len(rows) < 3 or rows[0][0] == 0:
+                # Edge cases go through properties(), so they behave exactly the same
+                results[i] = self.properties(rows)
+            else:
+                to_vectorise.append(i)
+
+        if len(to_vectorise) > 0:
+            vectorised_results = self._properties_vectorised([rows_list[i] for i in to_vectorise])
+            for i, properties in zip(to_vectorise, vectorised_results):
+                results[i] = properties
+
+        return results
+
+    def _properties_vectorised(self, rows_list):
+        """
+        The same as properties(), for many cells at once. Every cell has at
+        least 3 rows, sorted by distance. The cells are turned into a (cells x
+        rows) matrix of distances, and matrices of integer codes for the
+        religion and (religion, denomination), then every window (top 10,
+        within 5km etc.) is counted with one bincount over a prefix mask.
+
+        Where 2 values are equally common, the one which appears nearest wins.
+        """
+        import numpy
+
+        num_cells = len(rows_list)
+        width = max(len(rows) for rows in rows_list)
+
+        religion_codes, pair_codes = {}, {}
+        pair_religion, pair_denomination = [], []
+        distances = numpy.full((num_cells, width), numpy.inf)
+        religions = numpy.full((num_cells, width), -1, dtype=int)
+        pairs = numpy.full((num_cells, width), -1, dtype=int)
+        lengths = numpy.array([len(rows) for rows in rows_list])
+
+        for i, rows in enumerate(rows_list):
+            for j, (distance, religion, denomination) in enumerate(rows):
+                distances[i, j] = distance
+                religion_code = religion_codes.setdefault(religion, len(religion_codes))
+                religions[i, j] = religion_code
+                if (religion, denomination) not in pair_codes:
+                    pair_codes[religion, denomination] = len(pair_codes)
+                    pair_religion.append(religion_code)
+                    pair_denomination.append(denomination)
+                pairs[i, j] = pair_codes[religion, denomination]
+
+        num_religions, num_pairs = len(religion_codes), len(pair_codes)
+        religion_names = sorted(religion_codes, key=religion_codes.get)
+        pair_religion = numpy.array(pair_religion)
+
+        # The padding gets it's own code, which is dropped from the counts
+        religions[religions == -1] = num_religions
+        pairs[pairs == -1] = num_pairs
+        cells = numpy.arange(num_cells)
+
+        def window_counts(codes, num_codes, window_lengths, weights=None):
+            """(cells x codes) counts of each code, in the first window_lengths rows of each cell"""
+            mask = numpy.arange(width) < window_lengths[:, None]
+            flat = (cells[:, None] * (num_codes + 1) + codes)[mask]
+            if weights is not None:
+                weights = weights[mask]
+            counts = numpy.bincount(flat, weights=weights, minlength=num_cells * (num_codes + 1))
+            return counts.reshape(num_cells, num_codes + 1)[:, :num_codes]
+
+        def first_seen(codes, num_codes):
+            """(cells x codes) the position of the first (nearest) row with that code"""
+            first = numpy.full((num_cells, num_codes + 1), width, dtype=int)
+            for j in range(width - 1, -1, -1):
+                first[cells, codes[:, j]] = j
+            return first[:, :num_codes]
+
+        religion_first, pair_first = first_seen(religions, num_religions), first_seen(pairs, num_pairs)
+
+        def most_common(counts, first, allowed=None):
+            key = counts * (width + 1) - first
+            key[counts == 0] = -1
+            if allowed is not None:
+                key[~allowed] = -1
+            return key.argmax(axis=1)
+
+        def most_common_in_window(window_lengths):
+            """List of (religion, denomination), or None if the window is empty, for each cell"""
+            religion = most_common(window_counts(religions, num_religions, window_lengths), religion_first)
+            allowed = pair_religion[None, :] == religion[:, None]
+            pair = most_common(window_counts(pairs, num_pairs, window_lengths), pair_first, allowed)
+            return [(religion_names[r], pair_denomination[p]) if n > 0 else None for r, p, n in zip(religion, pair, window_lengths)]
+
+        windows = [
+            ('most_common_religion', 'most_common_denomination', lengths),
+            ('most_common_10_religion', 'most_common_10_denomination', numpy.minimum(lengths, 10)),
+            ('most_common_religion_wi_50km', 'most_common_denomination_wi_50km', (distances <= 50000).sum(axis=1)),
+            ('most_common_religion_wi_10km', 'most_common_denomination_wi_10km', (distances <= 10000).sum(axis=1)),
+            ('most_common_religion_wi_5km', 'most_common_denomination_wi_5km', (distances <= 5000).sum(axis=1)),
+        ]
+        window_results = [(religion_key, denomination_key, most_common_in_window(window_lengths)) for (religion_key, denomination_key, window_lengths) in windows]
+
+        # Sum of 1/distance for each religion
+        present = window_counts(religions, num_religions, lengths) > 0
+        scores = window_counts(religions, num_religions, lengths, weights=1 / distances)
+        weighted = numpy.where(present, scores, numpy.inf).argmin(axis=1)
+
+        score_keys = [('christian_score', 'christian'), ('muslim_score', 'muslim'), ('jewish_score', 'jewish'),
+                      ('shinto_score', 'shinto'), ('buddhist_score', 'buddhist'), ('hindu_score', 'hindu')]
+
+        defaults = self.properties([])
+        results = []
+        for i in range(num_cells):
+            result = dict(defaults)
+            result['closest_religion'] = religion_names[religions[i, 0]]
+            result['closest_denomination'] = pair_denomination[pairs[i, 0]]
+            result['closest_pow'] = float(distances[i, 0])
+            result['closest_3_pow'] = float(distances[i, 2])
+
+            for religion_key, denomination_key, cell_results in window_results:
+                if cell_results[i] is not None:
+                    result[religion_key], result[denomination_key] = cell_results[i]
+
+            for key, religion in score_keys:
+                code = religion_codes.get(religion)
+                result[key] = float(scores[i, code]) if code is not None and present[i, code] else None
+
+            result['weighted_most_common_religion'] = religion_names[weighted[i]]
+            results.append(result)
+
+        return results
+
 
     def clean_row_data(self, row):
         return row
 
+class ClosestReligionMap(ReligionMap):
+    """
+    Only the closest place of worship. Use --nearest-site to get them from a
+    Voronoi diagram of the input, rather than the nearest neighbours of every
+    cell, which is much quicker for fine grids.
+    """
+    sql_statistics = dict((k, ReligionMap.sql_statistics[k]) for k in ['closest_religion', 'closest_denomination', 'closest_pow'])
+
+    def neighbour_requirements(self):
+        return [(1, None)]
+
+    def properties(self, rows):
+        results = {
+            'closest_religion': '',
+            'closest_denomination': '',
+            'closest_pow': 0,
+        }
+        if len(rows) > 0:
+            results['closest_pow'], results['closest_religion'], results['closest_denomination'] = rows[0]
+        return results
+
+    def properties_many(self, rows_list):
+        # Nothing to vectorise
+        return [self.properties(rows) for rows in rows_list]
+
 class PointMap(object):
     output_geom_type = 'point'
 
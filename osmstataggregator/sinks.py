@@ -0,0 +1,261 @@
+# encoding: utf-8
+"""
+Write the results to a file as they are calculated, rather than (or as well
+as) to the output table.
+
+When a run is resumed, the cells done last time are already in the sink, so
+it's opened with append=True. GeoJSONSeq & OGR sinks are added to; a raster
+can't be, since the text codes of the last run are lost.
+
+Newline delimited GeoJSON needs nothing extra. GeoPackage & FlatGeobuf need
+the GDAL python bindings. Rasters need numpy (and GDAL for GeoTIFF).
+"""
+import json
+import os
+import tempfile
+
+
+class GeoJSONSeqSink(object):
+    """Newline delimited GeoJSON, one feature per line"""
+
+    def __init__(self, filename, aggregator, buffer_size=1000, append=False):
+        self.fp = open(filename, 'a' if append else 'w')
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def write(self, geometry, properties):
+        """geometry is a GeoJSON geometry dict"""
+        self.buffer.append(json.dumps({'type': 'Feature', 'geometry': geometry, 'properties': properties}))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.fp.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+            self.fp.flush()
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+
+
+class OGRSink(object):
+    """Any OGR vector format (e.g. GeoPackage, FlatGeobuf), written in transactions of buffer_size features"""
+
+    def __init__(self, filename, aggregator, driver_name, buffer_size=1000, append=False):
+        from osgeo import ogr, osr
+        self.ogr = ogr
+
+        if append:
+            self.datasource = ogr.Open(filename, 1)
+            if self.datasource is None:
+                raise ValueError("Can't open {0} to add to it".format(filename))
+            self.layer = self.datasource.GetLayer(0)
+        else:
+            driver = ogr.GetDriverByName(driver_name)
+            if driver is None:
+                raise ValueError("GDAL has no {0} driver".format(driver_name))
+            self.datasource = driver.CreateDataSource(filename)
+
+            srs = osr.SpatialReference()
+            srs.ImportFromEPSG(aggregator.srid)
+            self.layer = self.datasource.CreateLayer(str(aggregator.output_table or "output"), srs, ogr.wkbMultiPolygon)
+
+            possible_columns = aggregator.properties([])
+            for column in sorted(possible_columns):
+                if aggregator.property_column_type(possible_columns[column]) == "REAL":
+                    field_type = ogr.OFTReal
+                else:
+                    field_type = ogr.OFTString
+                self.layer.CreateField(ogr.FieldDefn(str(column), field_type))
+
+        self.buffer_size = buffer_size
+        self.in_transaction = 0
+
+    def write(self, geometry, properties):
+        """geometry is a GeoJSON geometry dict"""
+        if self.in_transaction == 0:
+            self.layer.StartTransaction()
+
+        feature = self.ogr.Feature(self.layer.GetLayerDefn())
+        feature.SetGeometry(self.ogr.ForceToMultiPolygon(self.ogr.CreateGeometryFromJson(json.dumps(geometry))))
+        for key, value in properties.items():
+            if value is not None:
+                feature.SetField(str(key), value)
+        self.layer.CreateFeature(feature)
+
+        self.in_transaction += 1
+        if self.in_transaction >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.in_transaction > 0:
+            self.layer.CommitTransaction()
+            self.in_transaction = 0
+
+    def close(self):
+        self.flush()
+        # This is how you close a file with OGR
+        self.layer = None
+        self.datasource = None
+
+
+def geometry_centre(geometry):
+    """The centre of the bounding box of a GeoJSON geometry dict"""
+    def points(coords):
+        if isinstance(coords[0], (int, float)):
+            yield coords
+        else:
+            for c in coords:
+                for point in points(c):
+                    yield point
+
+    xs, ys = zip(*[(p[0], p[1]) for p in points(geometry['coordinates'])])
+    return (min(xs) + max(xs)) / 2.0, (min(ys) + max(ys)) / 2.0
+
+
+class RasterSink(object):
+    """
+    For regular grids, write each property as a band of a raster, indexed by
+    the cell's row & column in the grid, rather than as a polygon per cell.
+
+    Numeric properties are float32 bands (NaN for no data). Text properties
+    are int32 bands of codes (-1 for no data), with the code to value lookup
+    table in the sidecar JSON file. The sidecar also has the georeference
+    (a GDAL style geotransform).
+
+    filename 'out.npy' writes 'out.PROPERTY.npy' per band and 'out.json'.
+    filename 'out.tif' writes a multiband GeoTIFF, and 'out.json'.
+    """
+
+    def __init__(self, filename, aggregator, append=False):
+        import numpy
+        from numpy.lib.format import open_memmap
+
+        if append:
+            raise ValueError("Can't add to the raster {0} from the last run, use --recalculate-properties to rewrite it".format(filename))
+        if aggregator.output_geom_type == 'polygon' and (aggregator.cut_land_boxes or aggregator.adaptive):
+            raise ValueError("Can only write a raster for a regular grid, i.e. point or uncut polygon output")
+
+        self.numpy = numpy
+        self.filename = filename
+        self.is_geotiff = filename.endswith((".tif", ".tiff"))
+        # The GeoTIFF stores codes as float32, which is only exact up to 2**24
+        self.max_codes = 2 ** 24 if self.is_geotiff else 2 ** 31 - 1
+        self.prefix = os.path.splitext(filename)[0]
+        self.minlon, self.minlat, self.increment, self.srid = aggregator.minlon, aggregator.minlat, aggregator.increment, aggregator.srid
+        self.width, self.height = aggregator.grid_shape()
+
+        if self.is_geotiff:
+            # The bands are built up in temporary files, and put in the GeoTIFF at the end
+            self.band_dir = tempfile.mkdtemp()
+        else:
+            self.band_dir = None
+
+        possible_columns = aggregator.properties([])
+        self.bands = {}
+        self.categories = {}
+        for column in sorted(possible_columns):
+            if aggregator.property_column_type(possible_columns[column]) == "REAL":
+                dtype, nodata = numpy.float32, numpy.nan
+            else:
+                dtype, nodata = numpy.int32, -1
+                self.categories[column] = {}
+            band = open_memmap(self.band_filename(column), mode='w+', dtype=dtype, shape=(self.height, self.width))
+            band[:] = nodata
+            self.bands[column] = band
+
+    def band_filename(self, column):
+        if self.band_dir is not None:
+            return os.path.join(self.band_dir, column + ".npy")
+        else:
+            return "{0}.{1}.npy".format(self.prefix, column)
+
+    def write(self, geometry, properties):
+        x, y = geometry_centre(geometry)
+        col = int((x - self.minlon) // self.increment)
+        # north up
+        row = self.height - 1 - int((y - self.minlat) // self.increment)
+        if not (0 <= col < self.width and 0 <= row < self.height):
+            return
+
+        for column, value in properties.items():
+            if value is None:
+                continue
+            if column in self.categories:
+                codes = self.categories[column]
+                if value not in codes:
+                    if len(codes) >= self.max_codes:
+                        raise ValueError("Property {0} has more than {1} different values, too many to store as codes in a raster".format(column, self.max_codes))
+                    codes[value] = len(codes)
+                value = codes[value]
+            self.bands[column][row, col] = value
+
+    def flush(self):
+        for band in self.bands.values():
+            band.flush()
+
+    def close(self):
+        self.flush()
+
+        sidecar = {
+            'width': self.width,
+            'height': self.height,
+            'srid': self.srid,
+            'geotransform': [self.minlon, self.increment, 0, self.minlat + self.height * self.increment, 0, -self.increment],
+            'bands': {},
+        }
+        for i, column in enumerate(sorted(self.bands)):
+            band_info = {'index': i + 1, 'dtype': str(self.bands[column].dtype)}
+            if column in self.categories:
+                band_info['nodata'] = -1
+                band_info['categories'] = sorted(self.categories[column], key=self.categories[column].get)
+            if not self.is_geotiff:
+                band_info['file'] = os.path.basename(self.band_filename(column))
+            sidecar['bands'][column] = band_info
+
+        if self.is_geotiff:
+            self.write_geotiff(sidecar)
+
+        with open(self.prefix + ".json", 'w') as fp:
+            json.dump(sidecar, fp, indent=2)
+
+        self.bands = {}
+
+    def write_geotiff(self, sidecar):
+        from osgeo import gdal, osr
+
+        columns = sorted(self.bands)
+        # One data type for all bands, so the codes are stored as floats too
+        dataset = gdal.GetDriverByName("GTiff").Create(self.filename, self.width, self.height, len(columns), gdal.GDT_Float32, ["COMPRESS=DEFLATE", "TILED=YES"])
+        dataset.SetGeoTransform(sidecar['geotransform'])
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(self.srid)
+        dataset.SetProjection(srs.ExportToWkt())
+
+        for i, column in enumerate(columns):
+            band = dataset.GetRasterBand(i + 1)
+            band.SetDescription(column)
+            if column in self.categories:
+                band.SetNoDataValue(-1)
+                band.SetCategoryNames(sidecar['bands'][column]['categories'])
+            band.WriteArray(self.bands[column])
+            os.remove(self.band_filename(column))
+
+        dataset.FlushCache()
+        dataset = None
+        os.rmdir(self.band_dir)
+
+
+def open_sink(filename, aggregator, append=False):
+    """Open the right kind of sink for this filename"""
+    if filename.endswith((".npy", ".tif", ".tiff")):
+        return RasterSink(filename, aggregator, append=append)
+    elif filename.endswith(".gpkg"):
+        return OGRSink(filename, aggregator, "GPKG", append=append)
+    elif filename.endswith(".fgb"):
+        return OGRSink(filename, aggregator, "FlatGeobuf", append=append)
+    else:
+        # e.g. .geojsonl, .geojsons, .ndjson
+        return GeoJSONSeqSink(filename, aggregator, append=append)
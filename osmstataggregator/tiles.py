@@ -0,0 +1,216 @@
+# encoding: utf-8
+"""
+Split a run into tiles, which any number of worker processes take from a
+work queue table in the database, and calculate.
+
+The coordinator (--coordinator) makes the output table, and the queue table
+(OUTPUT_TABLE__tiles) with one row per tile. Each worker (--worker), on any
+machine that can reach the database, claims a tile (with FOR UPDATE SKIP
+LOCKED, so workers never wait for each other), and makes the land boxes, raw
+data & properties of the cells in it. A claim is a lease, which is renewed
+between phases. If a worker dies, it's lease runs out and another worker
+retries the tile. Workers stop when there are no tiles left to claim, so more
+can be started at any time. Once every tile is done, the coordinator converts
+to polygons etc. as usual.
+
+e.g.
+    python religion_map.py --coordinator --worker --tile-size 5 ...   # on one machine
+    python religion_map.py --worker ...                               # on as many others as you like
+"""
+from __future__ import division
+
+import math
+import os
+import socket
+import time
+
+from common import copy_rows
+
+
+class TileQueue(object):
+
+    # How often the coordinator checks if all the tiles are done (in seconds)
+    poll_interval = 10
+
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+        self.tiles_table = aggregator.output_table + "__tiles"
+        self.worker_id = "{0}:{1}".format(socket.gethostname(), os.getpid())
+
+    def create_tiles(self, conn):
+        """Make the queue table, with a pending row for each tile of the area (unless it's already there)"""
+        agg = self.aggregator
+        db_cursor = conn.cursor()
+        query = """CREATE TABLE IF NOT EXISTS {tiles_table} (
+                id serial PRIMARY KEY,
+                minlon float8, minlat float8, maxlon float8, maxlat float8,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT, lease_expires TIMESTAMP WITH TIME ZONE, attempts INTEGER NOT NULL DEFAULT 0
+            );"""
+        db_cursor.execute(query.format(tiles_table=self.tiles_table))
+
+        db_cursor.execute("SELECT 1 FROM {0} LIMIT 1;".format(self.tiles_table))
+        if len(db_cursor.fetchall()) > 0:
+            print "Table {0} already has tiles, not re-creating them".format(self.tiles_table)
+            conn.commit()
+            return
+
+        # Positions are calculated from the integer index, so tiles line up with the cells
+        num_x = int(math.ceil(((agg.maxlon - agg.minlon) / agg.tile_size) - 1e-9))
+        num_y = int(math.ceil(((agg.maxlat - agg.minlat) / agg.tile_size) - 1e-9))
+        tiles = ((agg.minlon + x * agg.tile_size, agg.minlat + y * agg.tile_size,
+                  min(agg.minlon + (x + 1) * agg.tile_size, agg.maxlon), min(agg.minlat + (y + 1) * agg.tile_size, agg.maxlat))
+                 for y in range(num_y) for x in range(num_x))
+        copy_rows(db_cursor, self.tiles_table, ["minlon", "minlat", "maxlon", "maxlat"], tiles)
+        conn.commit()
+        print "Made {0} tiles in {1}".format(num_x * num_y, self.tiles_table)
+
+    def claim_tile(self, conn):
+        """
+        Lease a pending tile (or one whose lease has run out) to this worker.
+        Returns (id, minlon, minlat, maxlon, maxlat), or None if there are no
+        tiles left to claim.
+        """
+        db_cursor = conn.cursor()
+        query = """UPDATE {tiles_table} SET status = 'running', worker = %s, lease_expires = now() + %s * interval '1 second', attempts = attempts + 1
+            WHERE id = (
+                SELECT id FROM {tiles_table}
+                WHERE (status = 'pending' OR (status = 'running' AND lease_expires < now())) AND attempts < %s
+                ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, minlon, minlat, maxlon, maxlat;"""
+        db_cursor.execute(query.format(tiles_table=self.tiles_table), [self.worker_id, self.aggregator.lease_seconds, self.aggregator.max_tile_attempts])
+        rows = db_cursor.fetchall()
+        conn.commit()
+        db_cursor.close()
+        return rows[0] if len(rows) > 0 else None
+
+    def renew_lease(self, conn, tile_id):
+        """Extend our lease on this tile. Returns False if we've lost it (i.e. it's run out & another worker has it)"""
+        db_cursor = conn.cursor()
+        query = "UPDATE {tiles_table} SET lease_expires = now() + %s * interval '1 second' WHERE id = %s AND worker = %s AND status = 'running';"
+        db_cursor.execute(query.format(tiles_table=self.tiles_table), [self.aggregator.lease_seconds, tile_id, self.worker_id])
+        renewed = db_cursor.rowcount == 1
+        conn.commit()
+        db_cursor.close()
+        return renewed
+
+    def finish_tile(self, conn, tile_id, status):
+        """Set the status of our tile. A failed tile goes back in the queue, until it's been tried max_tile_attempts times"""
+        db_cursor = conn.cursor()
+        query = """UPDATE {tiles_table} SET lease_expires = NULL,
+                status = CASE WHEN %s = 'done' THEN 'done' WHEN attempts >= %s THEN 'failed' ELSE 'pending' END
+            WHERE id = %s AND worker = %s AND status = 'running';"""
+        db_cursor.execute(query.format(tiles_table=self.tiles_table), [status, self.aggregator.max_tile_attempts, tile_id, self.worker_id])
+        conn.commit()
+        db_cursor.close()
+
+    def tile_scope_sql(self, minlon, minlat, maxlon, maxlat):
+        """SQL condition for an output row being in this tile, i.e. the centre of it's cell is in the tile"""
+        agg = self.aggregator
+        point = agg.output_geom_as_point_sql()
+        envelope = "ST_MakeEnvelope({0!r}, {1!r}, {2!r}, {3!r}, {4})".format(minlon, minlat, maxlon, maxlat, agg.srid)
+        return "{output_table}.{output_geom_col} && {envelope} AND ST_X({point}) >= {minlon!r} AND ST_X({point}) < {maxlon!r} AND ST_Y({point}) >= {minlat!r} AND ST_Y({point}) < {maxlat!r}".format(
+            output_table=agg.output_table, output_geom_col=agg.output_geom_col, envelope=envelope, point=point,
+            minlon=minlon, minlat=minlat, maxlon=maxlon, maxlat=maxlat)
+
+    def process_tile(self, conn, tile):
+        """
+        Make the land boxes, raw data & properties of one tile. Returns False
+        if we lost the lease on the way.
+        """
+        agg = self.aggregator
+        tile_id, minlon, minlat, maxlon, maxlat = tile
+        # The last cells can stick out past the edge of the area
+        scope_maxlon = maxlon + agg.increment if maxlon >= agg.maxlon else maxlon
+        scope_maxlat = maxlat + agg.increment if maxlat >= agg.maxlat else maxlat
+
+        saved = (agg.minlon, agg.minlat, agg.maxlon, agg.maxlat, agg.cell_scope)
+        agg.minlon, agg.minlat, agg.maxlon, agg.maxlat = minlon, minlat, maxlon, maxlat
+        agg.cell_scope = self.tile_scope_sql(minlon, minlat, scope_maxlon, scope_maxlat)
+        try:
+            # Anything left from a worker which died on this tile
+            db_cursor = conn.cursor()
+            db_cursor.execute("DELETE FROM {0} WHERE {1};".format(agg.output_table, agg.cell_scope))
+            conn.commit()
+            db_cursor.close()
+
+            for step in [lambda: agg.insert_land_boxes(conn), agg.populate_raw_data, agg.calculate_properties]:
+                if not self.renew_lease(conn, tile_id):
+                    print "Lost the lease on tile {0}, leaving it".format(tile_id)
+                    return False
+                step()
+            return True
+        finally:
+            agg.minlon, agg.minlat, agg.maxlon, agg.maxlat, agg.cell_scope = saved
+
+    def work(self, conn):
+        """Claim & calculate tiles until there are none left"""
+        while True:
+            tile = self.claim_tile(conn)
+            if tile is None:
+                print "No more tiles to claim"
+                return
+
+            print "\nWorker {0} doing tile {1} ({2}, {3}) - ({4}, {5})".format(self.worker_id, *tile)
+            try:
+                with self.aggregator.instrumentation.phase('tile {0}'.format(tile[0])):
+                    finished = self.process_tile(conn, tile)
+            except Exception:
+                conn.rollback()
+                self.finish_tile(conn, tile[0], 'failed')
+                raise
+            if finished:
+                self.finish_tile(conn, tile[0], 'done')
+
+    def wait_for_tiles(self, conn):
+        """Wait until no tiles are pending or being worked on. Raises an exception if any failed"""
+        db_cursor = conn.cursor()
+        while True:
+            # Tiles whose last lease ran out, and won't be retried
+            query = "UPDATE {tiles_table} SET status = 'failed' WHERE status = 'running' AND lease_expires < now() AND attempts >= %s;"
+            db_cursor.execute(query.format(tiles_table=self.tiles_table), [self.aggregator.max_tile_attempts])
+            db_cursor.execute("SELECT status, count(*) FROM {0} GROUP BY status;".format(self.tiles_table))
+            counts = dict(db_cursor.fetchall())
+            conn.commit()
+
+            remaining = counts.get('pending', 0) + counts.get('running', 0)
+            print "Tiles: {0} done, {1} pending, {2} running, {3} failed".format(counts.get('done', 0), counts.get('pending', 0), counts.get('running', 0), counts.get('failed', 0))
+            if remaining == 0:
+                break
+            time.sleep(self.poll_interval)
+
+        db_cursor.close()
+        if counts.get('failed', 0) > 0:
+            raise Exception("{0} tiles failed, see the rows with status 'failed' in {1}".format(counts['failed'], self.tiles_table))
+
+    def run(self):
+        agg = self.aggregator
+        conn = agg.database_connection()
+
+        if agg.coordinator:
+            with agg.instrumentation.phase('create_table'):
+                agg.create_table()
+            with agg.instrumentation.phase('prepare_land'):
+                agg.prepare_land()
+            with agg.instrumentation.phase('create_tiles'):
+                self.create_tiles(conn)
+        else:
+            with agg.instrumentation.phase('prepare_land'):
+                agg.prepare_land()
+
+        if agg.worker:
+            self.work(conn)
+
+        if agg.coordinator:
+            with agg.instrumentation.phase('wait_for_tiles'):
+                self.wait_for_tiles(conn)
+
+            with agg.instrumentation.phase('convert_to_polygons'):
+                agg.convert_to_polygons()
+
+            if agg.pyramid_levels > 0:
+                with agg.instrumentation.phase('build_pyramid'):
+                    agg.build_pyramid()
+
+        agg.instrumentation.print_summary()